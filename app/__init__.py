@@ -9,17 +9,22 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 
 from . import (
     api,
+    archive,
     auth,
     db,
     error,
+    export,
     extensions,
     format_calldata,
+    import_history,
     internal,
     jobs,
     live_view,
     main,
     model,
     parse_xml,
+    retention,
+    stats,
     utils,
     version,
 )
@@ -58,14 +63,28 @@ def create_app(test_config=None, minimal_app=False):
         SECRET_KEY=b85encode(os.urandom(32)).decode(encoding='ascii'),
         INTERNAL_URL='http://localhost:5000/',
         DATABASE=os.path.join(app.instance_path, 'data.sqlite'),
+        DATABASE_POOL_SIZE=8,
+        DATABASE_PROFILE='balanced',
         SESSION_COOKIE_HTTPONLY=True,
         REMEMBER_COOKIE_HTTPONLY=True,
         SESSION_COOKIE_SECURE=not app.debug,
         REMEMBER_COOKIE_SECURE=not app.debug,
         ZISSON_SFTP_HOST='ftp.zisson.com',
+        ZISSON_SFTP_CONNECTIONS=4,
+        ZISSON_SFTP_RETRIES=3,
         ZISSON_API_HOST='api.zisson.com',
+        ZISSON_API_SCHEME='https',
+        ZISSON_API_CONNECT_TIMEOUT=10,
+        ZISSON_API_READ_TIMEOUT=120,
+        ZISSON_API_RETRIES=3,
         ZISSON_STATUS_URL='https://zisson-kva.statuspage.io/',
         MIN_PASSWORD_SCORE=3,
+        FETCH_CALL_DATA_READ_AHEAD=0,
+        ARCHIVE_AFTER_DAYS=90,
+        RETENTION_CALL_DATA_DAYS=0, # forever
+        RETENTION_BLOCKED_IP_DAYS=30,
+        RETENTION_RECORDING_DAYS=7, # fetch.MAX_RECORDING_AGE
+        RETENTION_BATCH_SIZE=500,
     )
     # config from config.py (or test_config) overrides hardcoded values
     if test_config is not None:
@@ -76,13 +95,21 @@ def create_app(test_config=None, minimal_app=False):
     # environment variables overrides config.py and hardcoded values
     envconfig(app, 'SECRET_KEY', required=True, nonempty=True)
     envconfig(app, 'INTERNAL_URL')
+    envconfig(app, 'DATABASE_POOL_SIZE')
+    envconfig(app, 'DATABASE_PROFILE')
     envconfig(app, 'ZISSON_API_HOST', required=True, nonempty=True)
+    envconfig(app, 'ZISSON_API_SCHEME')
+    envconfig(app, 'ZISSON_API_CONNECT_TIMEOUT')
+    envconfig(app, 'ZISSON_API_READ_TIMEOUT')
+    envconfig(app, 'ZISSON_API_RETRIES')
     envconfig(app, 'ZISSON_STATUS_URL', required=True, nonempty=True)
     envconfig(app, 'ZISSON_API_USERNAME', required=False, nonempty=True)
     envconfig(app, 'ZISSON_API_PASSWORD', required=False, nonempty=True)
     envconfig(app, 'ZISSON_SFTP_USERNAME', required=False, nonempty=True)
     envconfig(app, 'ZISSON_SFTP_PASSWORD', required=False, nonempty=True)
     envconfig(app, 'ZISSON_SFTP_HOST_KEY', required=False, nonempty=True)
+    envconfig(app, 'ZISSON_SFTP_CONNECTIONS')
+    envconfig(app, 'ZISSON_SFTP_RETRIES')
     envconfig(app, 'REDIS_HOST')
     envconfig(app, 'REDIS_PORT')
     envconfig(app, 'REDIS_DB')
@@ -94,6 +121,13 @@ def create_app(test_config=None, minimal_app=False):
         app.config['REMEMBER_COOKIE_SECURE'] = False
     envconfig(app, 'TRUSTED_PROXIES_COUNT')
     envconfig(app, 'MIN_PASSWORD_SCORE')
+    envconfig(app, 'FETCH_CALL_DATA_READ_AHEAD')
+    envconfig(app, 'ARCHIVE_DIR')
+    envconfig(app, 'ARCHIVE_AFTER_DAYS')
+    envconfig(app, 'RETENTION_CALL_DATA_DAYS')
+    envconfig(app, 'RETENTION_BLOCKED_IP_DAYS')
+    envconfig(app, 'RETENTION_RECORDING_DAYS')
+    envconfig(app, 'RETENTION_BATCH_SIZE')
 
     if ('TRUSTED_PROXIES_COUNT' in app.config):
         trusted_proxies_count = int(app.config['TRUSTED_PROXIES_COUNT'])
@@ -121,11 +155,17 @@ def create_app(test_config=None, minimal_app=False):
     csrf.init_app(app)
     app.register_blueprint(api.api)
     app.register_blueprint(main.main)
+    app.register_blueprint(export.export)
+    app.register_blueprint(stats.stats)
     app.register_blueprint(internal.internal)
     csrf.exempt(api.api)
     csrf.exempt(internal.internal)
     error.init_app(app)
     keyvalue.init_app(app)
+    format_calldata.init_app(app)
+    import_history.init_app(app)
+    retention.init_app(app)
+    stats.init_app(app)
 
     app.add_template_global(phone_number_lookup_link)
     app.add_template_global(pretty_print_phone_no)
@@ -7,9 +7,11 @@ from app.zisson_api import email_to_current_phone
 
 from .auth import api_require_role
 from .db import get_db, transaction
-from .model.call_data import upsert_call_channels, upsert_call_sessions, upsert_recordings
-from .parse_xml import parse_call_data
+from .format_calldata import store_call_session_summaries
+from .model.call_data import upsert_call_data
+from .parse_xml import iter_call_data
 from .live_view import push_updates
+from .stats import store_call_session_stats
 from .zisson_api import email_to_current_phone, dial
 from .utils import get_conversion
 
@@ -20,18 +22,22 @@ api = Blueprint('api', __name__)
 @api.route('/api/zisson/push', methods=['POST'])
 @api_require_role('zisson_push')
 def receive_zisson_data():
+    db = get_db()
+    changed_rows = 0
     try:
-        call_sessions, call_channels, recordings = parse_call_data(request.data)
+        with transaction(db):
+            call_session_ids = []
+            for call_session, call_channels, recordings in iter_call_data(request.data):
+                changed_rows += upsert_call_data(db, call_session,
+                                                 call_channels, recordings)
+                call_session_ids.append(call_session.call_session_id)
+            store_call_session_summaries(db, call_session_ids)
+            store_call_session_stats(db, call_session_ids)
     except SyntaxError:
         current_app.logger.warn('Zisson push message is malformed')
         return "malformed data'n", 400
-
-    db = get_db()
-    with transaction(db):
-        db.executemany(upsert_call_sessions, call_sessions)
-        db.executemany(upsert_call_channels, call_channels)
-        db.executemany(upsert_recordings, recordings)
-    push_updates()
+    if changed_rows:
+        push_updates()
     return "ok\n"
 
 
@@ -0,0 +1,214 @@
+"""Monthly archive databases for old call data
+
+Closed call sessions older than ARCHIVE_AFTER_DAYS are moved, with their
+call channels and recordings, from the main database to one SQLite file
+per month (by start time, UTC) in ARCHIVE_DIR. Readers attach only the
+archives overlapping the time range they need.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import os
+import re
+import sqlite3
+
+from flask import current_app
+
+from .db import get_db, transaction
+from .model.call_data import (
+    CallChannel_fields,
+    CallSession_fields,
+    Recording_fields,
+)
+from .model.utils import generate_create_table_sql
+
+
+ARCHIVED_TABLES = (
+    ('call_sessions', CallSession_fields),
+    ('call_channels', CallChannel_fields),
+    ('recordings', Recording_fields),
+)
+
+
+_archive_schema = '\n'.join(
+    [generate_create_table_sql(name, fields) for name, fields in ARCHIVED_TABLES]
+    + ["""\
+create index call_sessions_start_timestamp_idx
+on call_sessions (start_timestamp);
+create index call_channels_call_session_idx
+on call_channels (call_session_id);
+create index recordings_call_session_id_idx
+on recordings (call_session_id);"""])
+
+
+_archive_file_regexp = re.compile(r'calls-(\d{4})-(\d{2})\.sqlite$')
+
+
+def archive_dir():
+    return (current_app.config.get('ARCHIVE_DIR')
+            or os.path.join(current_app.instance_path, 'archive'))
+
+
+def archive_file(year: int, month: int) -> str:
+    return os.path.join(archive_dir(), f'calls-{year:04d}-{month:02d}.sqlite')
+
+
+def _month_start(year: int, month: int) -> float:
+    return datetime(year, month, 1, tzinfo=timezone.utc).timestamp()
+
+
+def _next_month(year: int, month: int) -> tuple[int, int]:
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def month_end(year: int, month: int) -> float:
+    return _month_start(*_next_month(year, month))
+
+
+def _months_between(from_epoch: float, to_epoch: float):
+    """yields (year, month) of every month overlapping [from, to)"""
+    start = datetime.fromtimestamp(from_epoch, timezone.utc)
+    year, month = start.year, start.month
+    while _month_start(year, month) < to_epoch:
+        yield year, month
+        year, month = _next_month(year, month)
+
+
+def archived_months() -> list[tuple[int, int]]:
+    """returns (year, month) of the existing archives, oldest first"""
+    try:
+        names = os.listdir(archive_dir())
+    except FileNotFoundError:
+        return []
+    return sorted((int(match[1]), int(match[2])) for name in names
+                  if (match := _archive_file_regexp.match(name)))
+
+
+def archived_months_between(from_epoch: float, to_epoch: float) -> list[tuple[int, int]]:
+    """returns (year, month) of the existing archives overlapping [from, to)"""
+    return [(year, month) for year, month in _months_between(from_epoch, to_epoch)
+            if os.path.exists(archive_file(year, month))]
+
+
+def earliest_archived_timestamp() -> float|None:
+    if not (months := archived_months()):
+        return None
+    return _month_start(*months[0])
+
+
+def _create_archive(filename):
+    os.makedirs(os.path.dirname(filename), mode=0o700, exist_ok=True)
+    archive = sqlite3.connect(filename, isolation_level=None)
+    try:
+        if not archive.execute("select 1 from sqlite_master "
+                               "where name = 'call_sessions'").fetchone():
+            with transaction(archive):
+                archive.executescript(_archive_schema)
+    finally:
+        archive.close()
+
+
+def _attach(db, filename, schema):
+    if not any(row[1] == schema
+               for row in db.execute('pragma database_list').fetchall()):
+        db.execute('attach database ? as ' + schema, (filename, ))
+
+
+@contextmanager
+def attached_archive(db, year: int, month: int):
+    """attaches the archive of one month for the duration of the block
+
+    Yields the schema name it is attached as. SQLite allows only a few
+    attached databases at a time, so readers of many months attach them
+    one after the other with this.
+    """
+    schema = f'archive_{year:04d}_{month:02d}'
+    attached = any(row[1] == schema
+                   for row in db.execute('pragma database_list').fetchall())
+    if not attached:
+        db.execute('attach database ? as ' + schema, (archive_file(year, month), ))
+    try:
+        yield schema
+    finally:
+        if not attached:
+            db.execute(f'detach database {schema}')
+
+
+def find_recording(recording_id: bytes) -> tuple[float, float|None]|None:
+    """returns (start, stop) of a completed recording, or None
+
+    Looks in the main database first, then in the archives, newest first.
+    """
+    db = get_db()
+    sql = ('select start_timestamp, stop_timestamp from {schema}.recordings '
+           'where recording_id = ? and completed = 1')
+    if (row := db.execute(sql.format(schema='main'), (recording_id, )).fetchone()):
+        return tuple(row)
+    for year, month in reversed(archived_months()):
+        with attached_archive(db, year, month) as schema:
+            row = db.execute(sql.format(schema=schema), (recording_id, )).fetchone()
+        if row:
+            return tuple(row)
+    return None
+
+
+def _move_month(db, year, month, cutoff) -> int:
+    """moves the archivable call sessions of one month, returns the count"""
+    filename = archive_file(year, month)
+    schema = 'archive_target'
+    _create_archive(filename)
+    _attach(db, filename, schema)
+    try:
+        with transaction(db):
+            db.execute('create temp table if not exists archive_ids '
+                       '(call_session_id blob primary key)')
+            db.execute('delete from temp.archive_ids')
+            db.execute(
+                'insert into temp.archive_ids '
+                'select call_session_id from main.call_sessions '
+                'where start_timestamp >= ? and start_timestamp < ? '
+                'and start_timestamp < ? '
+                'and end_timestamp is not null '
+                'and not exists (select 1 from main.call_channels '
+                '    where call_channels.call_session_id = call_sessions.call_session_id '
+                '    and call_channels.active)',
+                (_month_start(year, month),
+                 month_end(year, month),
+                 cutoff))
+            for name, fields in ARCHIVED_TABLES:
+                columns = ', '.join(field[0] for field in fields)
+                db.execute(
+                    f'insert or replace into {schema}.{name} ({columns}) '
+                    f'select {columns} from main.{name} '
+                    f'where call_session_id in (select call_session_id from temp.archive_ids)')
+            # channels, recordings and summaries follow by cascade
+            moved = db.execute(
+                'delete from main.call_sessions '
+                'where call_session_id in (select call_session_id from temp.archive_ids)'
+            ).rowcount
+            db.execute('delete from temp.archive_ids')
+    finally:
+        db.execute(f'detach database {schema}')
+    return moved
+
+
+def archive_call_data():
+    """moves closed call sessions older than ARCHIVE_AFTER_DAYS to archives"""
+    db = get_db()
+    cutoff = (datetime.utcnow().timestamp()
+              - float(current_app.config['ARCHIVE_AFTER_DAYS']) * 24 * 60 * 60)
+    months = db.execute(
+        "select distinct strftime('%Y', start_timestamp, 'unixepoch'), "
+        "strftime('%m', start_timestamp, 'unixepoch') "
+        "from call_sessions "
+        "where start_timestamp < ? and end_timestamp is not null "
+        "order by 1, 2",
+        (cutoff, )).fetchall()
+    moved = 0
+    for year, month in ((int(year), int(month)) for year, month in months):
+        if (count := _move_month(db, year, month, cutoff)):
+            current_app.logger.info(f'Archived {count} call sessions to '
+                                    f'{archive_file(year, month)}')
+            moved += count
+    current_app.logger.info(f'Archived {moved} call sessions older than '
+                            f'{current_app.config["ARCHIVE_AFTER_DAYS"]} days')
@@ -1,13 +1,45 @@
+import os
+from queue import Empty, Full, LifoQueue
 import sqlite3
 from contextlib import contextmanager
+from threading import Lock
 
 from flask import current_app, g
 
 
 APPLICATION_ID=0xfeeb1e
-USER_VERSION=20220127
+USER_VERSION=20261025
+
+# per connection pragmas, selected by DATABASE_PROFILE
+DB_PROFILES = {
+    # sqlite's own defaults, fully synchronous
+    'safe': {
+        'synchronous': 'full',
+        'cache_size': -2000, # KiB
+        'mmap_size': 0,
+        'temp_store': 'default',
+        'busy_timeout': 5000, # ms
+    },
+    # with WAL, a crash of the application never loses a commit, only a
+    # power failure may lose the last ones
+    'balanced': {
+        'synchronous': 'normal',
+        'cache_size': -16000,
+        'mmap_size': 64 * 1024 * 1024,
+        'temp_store': 'memory',
+        'busy_timeout': 10000,
+    },
+    'fast': {
+        'synchronous': 'normal',
+        'cache_size': -64000,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'memory',
+        'busy_timeout': 30000,
+    },
+}
 
 _schema = ""
+_migrations = []
 
 
 def add_to_schema(sql):
@@ -16,9 +48,39 @@ def add_to_schema(sql):
     return sql
 
 
+def add_migration(user_version, migrate):
+    """registers `migrate(db)`, upgrading older databases to `user_version`
+
+    New databases are created from the current schema and never migrated.
+    Pending migrations run at startup in order of `user_version`, each in
+    its own transaction, with foreign keys disabled. Migrations run their
+    schema with `execute_script`, never `db.executescript`, which would
+    commit the transaction.
+    """
+    _migrations.append((user_version, migrate))
+    return migrate
+
+
+def execute_script(db, script):
+    """executes the statements of `script` one by one, with `db.execute`
+
+    Unlike `db.executescript`, which commits first, this keeps them in the
+    current transaction, as migrations must.
+    """
+    statement = ''
+    for part in script.split(';'):
+        statement += part + ';'
+        if sqlite3.complete_statement(statement):
+            if statement.strip(' \n;'):
+                db.execute(statement)
+            statement = ''
+
+
 @contextmanager
 def transaction(conn):
-    conn.execute('begin')
+    # take the write lock up front, so a concurrent writer makes us wait
+    # (busy_timeout) instead of failing with "database is locked" later
+    conn.execute('begin immediate')
     try:
         yield
     except:
@@ -28,36 +90,146 @@ def transaction(conn):
         conn.commit()
 
 
-def open_db(filename):
+def migrate_db(db):
+    for user_version, migrate in sorted(_migrations, key=lambda m: m[0]):
+        with transaction(db):
+            if db.execute('pragma user_version').fetchone()[0] >= user_version:
+                continue
+            migrate(db)
+            db.execute(f'pragma user_version={user_version}')
+
+
+def _connect(filename, profile):
+    # pooled connections move between threads (and greenlets), but are
+    # only used by one app context at a time
     db = sqlite3.connect(filename,
                          isolation_level=None,
-                         detect_types=sqlite3.PARSE_DECLTYPES)
+                         detect_types=sqlite3.PARSE_DECLTYPES,
+                         check_same_thread=False)
+    for pragma, value in DB_PROFILES[profile].items():
+        db.execute(f'pragma {pragma} = {value}')
+    return db
+
+
+def _configure(db):
+    db.row_factory = sqlite3.Row
+    db.execute('pragma foreign_keys = on')
+    return db
+
+
+def open_db(filename, profile='balanced'):
+    """opens `filename`, creating or migrating the database if needed"""
+    db = _connect(filename, profile)
     application_id = db.execute('pragma application_id').fetchone()[0]
     user_version = db.execute('pragma user_version').fetchone()[0]
+    new_db = application_id == 0 and user_version == 0
+    if new_db:
+        # only takes effect on an empty database, before journal_mode
+        db.execute('pragma auto_vacuum = incremental')
     db.execute('pragma journal_mode=WAL')
-    if application_id == 0 and user_version == 0:
+    if new_db:
         with transaction(db):
             db.executescript(_schema)
             db.execute(f'pragma application_id={APPLICATION_ID}')
             db.execute(f'pragma user_version={USER_VERSION}')
-    db.row_factory = sqlite3.Row
-    db.execute('pragma foreign_keys = on')
-    return db
+    elif user_version < USER_VERSION:
+        migrate_db(db)
+    return _configure(db)
+
+
+class ConnectionPool:
+    """long-lived connections to one database, for one process
+
+    Connections are checked out for the duration of an app context, and
+    returned to the pool afterwards, keeping SQLite's page cache and
+    statement cache warm. At most `size` idle connections are kept, more
+    are opened (and closed again) when needed. The database is validated
+    (created or migrated) once, by the first connection.
+    """
+    def __init__(self, filename, size, profile):
+        self.filename = filename
+        self.profile = profile
+        self.pid = os.getpid()
+        self._idle = LifoQueue(maxsize=size)
+        self._idle.put_nowait(open_db(filename, profile))
+
+    def checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            return _configure(_connect(self.filename, self.profile))
+
+    def checkin(self, db):
+        if db.in_transaction:
+            db.rollback()
+        for _, schema, _ in db.execute('pragma database_list').fetchall():
+            if schema not in ('main', 'temp'):
+                db.execute(f'detach database {schema}')
+        try:
+            self._idle.put_nowait(db)
+        except Full:
+            db.close()
+
+
+_pool_lock = Lock()
+_inherited_pools = [] # never closed, see _get_pool
+
+
+def _get_pool(app):
+    """returns the connection pool of `app` in this process, or None
+
+    A forked process (like an rq job) gets a pool of its own. The parent's
+    connections are kept open but unused, as closing a SQLite connection
+    inherited over fork may release the parent's locks.
+    """
+    if int(app.config['DATABASE_POOL_SIZE']) <= 0:
+        return None
+    with _pool_lock:
+        pool = app.extensions.get('db_pool')
+        if pool is None or pool.pid != os.getpid():
+            if pool is not None:
+                _inherited_pools.append(pool)
+            pool = ConnectionPool(app.config['DATABASE'],
+                                  int(app.config['DATABASE_POOL_SIZE']),
+                                  app.config['DATABASE_PROFILE'])
+            app.extensions['db_pool'] = pool
+        return pool
 
 
 def get_db():
     if 'db' not in g:
-        g.db = open_db(current_app.config['DATABASE'])
+        if (pool := _get_pool(current_app)) is None:
+            g.db = open_db(current_app.config['DATABASE'],
+                           current_app.config['DATABASE_PROFILE'])
+        else:
+            g.db = pool.checkout()
     return g.db
 
 
 def close_db(_=None): # ignore exception argument
     db = g.pop('db', None)
-    if db is not None:
+    if db is None:
+        return
+    if (pool := current_app.extensions.get('db_pool')) is not None \
+            and pool.pid == os.getpid():
+        pool.checkin(db)
+    else:
         db.close()
 
 
+def report_pragmas(db) -> dict:
+    """returns the effective values of the pragmas set by the profiles"""
+    pragmas = ['journal_mode', 'foreign_keys', *DB_PROFILES['safe']]
+    return {pragma: db.execute(f'pragma {pragma}').fetchone()[0]
+            for pragma in pragmas}
+
+
 def init_app(app):
+    if app.config['DATABASE_PROFILE'] not in DB_PROFILES:
+        raise ValueError(f"unknown DATABASE_PROFILE {app.config['DATABASE_PROFILE']}, "
+                         f"expected one of {', '.join(DB_PROFILES)}")
     app.teardown_appcontext(close_db)
     with app.app_context():
-        get_db()
+        pragmas = report_pragmas(get_db())
+        app.logger.info(f"database profile {app.config['DATABASE_PROFILE']}: "
+                        + ', '.join(f'{k}={v}' for k, v in pragmas.items()))
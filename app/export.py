@@ -0,0 +1,167 @@
+"""URLs exporting call history, for analysis elsewhere
+
+  /export/calls.csv?from=...&to=...[&gzip=1]
+  /export/calls.jsonl?from=...&to=...[&gzip=1]
+
+`from` and `to` are seconds since epoch, or ISO 8601 dates/timestamps.
+There is one row per call channel, with the columns of its call session
+first. The rows are streamed from a cursor, so memory use does not depend
+on the size of the range.
+"""
+
+import csv
+from datetime import datetime, timezone
+import io
+import json
+import zlib
+
+from flask import Blueprint, Response, request, stream_with_context
+
+from .archive import archived_months_between, attached_archive
+from .auth import login_require_role
+from .db import get_db
+from .model.call_data import CallChannel_fields
+from .parse_xml import (
+    CallDirectionT,
+    CallStateT,
+    EndPointClassT,
+    HangupByT,
+    HangupReasonT,
+)
+from .utils import epoch_arg, uuid_expand
+
+
+export = Blueprint('export', __name__)
+
+
+EXPORT_CHUNK_SIZE = 64 * 1024 # bytes per yielded chunk
+
+_channel_columns = [name for name, _, _ in CallChannel_fields
+                    if name != 'call_session_id']
+
+EXPORT_COLUMNS = ['call_session_id', 'start_timestamp', 'end_timestamp',
+                  *_channel_columns]
+
+_enum_columns = {
+    'call_direction': CallDirectionT,
+    'end_point_class': EndPointClassT,
+    'call_state': CallStateT,
+    'hangup_by': HangupByT,
+    'hangup_reason': HangupReasonT,
+}
+
+
+def _export_sql(schema):
+    channel_columns = ', '.join(f'call_channels.{name}' for name in _channel_columns)
+    return (
+        'select call_sessions.call_session_id, call_sessions.start_timestamp, '
+        f'call_sessions.end_timestamp, {channel_columns} '
+        f'from {schema}.call_sessions call_sessions '
+        f'join {schema}.call_channels call_channels using (call_session_id) '
+        'where call_sessions.start_timestamp >= ? '
+        'and call_sessions.start_timestamp < ? '
+        'order by call_sessions.start_timestamp, call_sessions.call_session_id, '
+        'call_channels.call_timestamp, call_channels.call_channel_id')
+
+
+def _iso_timestamp(epoch: float|None) -> str|None:
+    if epoch is None:
+        return None
+    return (datetime.fromtimestamp(epoch, timezone.utc)
+            .isoformat(timespec='milliseconds').replace('+00:00', 'Z'))
+
+
+def _convert(name, value):
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return uuid_expand(value)
+    if name.endswith('_timestamp'):
+        return _iso_timestamp(value)
+    if name in _enum_columns:
+        return _enum_columns[name](value).name
+    return value
+
+
+def _schema_rows(db, schema, from_epoch, to_epoch):
+    cursor = db.execute(_export_sql(schema), (from_epoch, to_epoch))
+    try:
+        while (rows := cursor.fetchmany(500)):
+            for row in rows:
+                yield {name: _convert(name, value)
+                       for name, value in zip(EXPORT_COLUMNS, row)}
+    finally:
+        cursor.close() # an archive can not be detached while read
+
+
+def export_rows(from_epoch, to_epoch):
+    """yields the exported rows as dicts, oldest call session first
+
+    Archives hold older call sessions than the main database. They are
+    attached one at a time, as SQLite limits the number attached at once.
+    """
+    db = get_db()
+    for year, month in archived_months_between(from_epoch, to_epoch):
+        with attached_archive(db, year, month) as schema:
+            yield from _schema_rows(db, schema, from_epoch, to_epoch)
+    yield from _schema_rows(db, 'main', from_epoch, to_epoch)
+
+
+def _csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, EXPORT_COLUMNS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _jsonl_lines(rows):
+    chunk = []
+    size = 0
+    for row in rows:
+        chunk.append(line := json.dumps(row) + '\n')
+        if (size := size + len(line)) >= EXPORT_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+    yield ''.join(chunk)
+
+
+def _encoded(chunks, compress):
+    compressor = zlib.compressobj(wbits=31) if compress else None # gzip
+    for chunk in chunks:
+        data = chunk.encode(encoding='utf-8')
+        if compressor is None:
+            yield data
+        elif (data := compressor.compress(data)):
+            yield data
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def _export_response(lines, filename, mimetype):
+    from_epoch, to_epoch = epoch_arg('from'), epoch_arg('to')
+    compress = request.args.get('gzip', '') not in ('', '0', 'false')
+    if compress:
+        filename, mimetype = filename + '.gz', 'application/gzip'
+    chunks = lines(export_rows(from_epoch, to_epoch))
+    return Response(stream_with_context(_encoded(chunks, compress)),
+                    mimetype=mimetype,
+                    headers={'Content-Disposition':
+                             f'attachment; filename={filename}'})
+
+
+@export.route('/export/calls.csv')
+@login_require_role('agent')
+def export_csv():
+    return _export_response(_csv_lines, 'calls.csv', 'text/csv')
+
+
+@export.route('/export/calls.jsonl')
+@login_require_role('agent')
+def export_jsonl():
+    return _export_response(_jsonl_lines, 'calls.jsonl', 'application/x-ndjson')
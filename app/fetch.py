@@ -1,7 +1,11 @@
 """Periodic tasks run from scheduler"""
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from hashlib import sha256
 import os
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+import time
 
 from flask import current_app
 from paramiko.ssh_exception import SSHException
@@ -11,134 +15,474 @@ import pysftp
 import requests
 
 from .db import get_db, transaction
+from .format_calldata import (
+    backfill_call_session_summaries,
+    store_call_session_summaries,
+)
 from .internal import send_push_updates
 from .model.call_data import (
-    upsert_call_channels,
-    upsert_call_sessions,
-    upsert_recordings,
-    recording_local_file
+    DownloadState,
+    recording_local_file,
+    select_pending_recordings,
+    update_recording_download,
+    upsert_call_data,
 )
-from .model.contacts import upsert_contacts
+from .model.contacts import Contact_fields, upsert_contacts
 from .model.customer_data import (
+    Agent_fields,
+    InternalPhone_fields,
+    upsert_agent_locations,
+    ServiceNumber_fields,
     upsert_agents,
     upsert_internal_phones,
     upsert_service_numbers,
 )
 from .model.keyvalue import get_value, set_value
-from .parse_xml import parse_call_data
+from .parse_xml import iter_call_data
 from .parse_xml import parse_contacts
 from .parse_xml import parse_customer_data
-from .utils import uuid_expand
+from .parse_xml import parse_logon_events
+from .stats import store_call_session_stats
+from .utils import uuid_compact, uuid_expand
 from .zisson_api import zisson_api_get
 
 
-def fetch_call_data():
-    db = get_db()
-    last_call_session_id = get_value('last_call_session_id')
-    updated = False
+def _is_recent(call_session):
+    return datetime.utcnow().timestamp() - call_session.start_timestamp <= 5 * 60
+
+
+def _store_call_data(db, call_data):
+    """upserts the (call_session, call_channels, recordings) of one page
+
+    The last_call_session_id watermark is moved, and the summaries of the
+    changed call sessions are computed, in the same transaction. Returns
+    the last call session (or None), the number of call sessions, and the
+    number of rows actually changed.
+    """
+    call_session = None
+    call_sessions_count = 0
+    changed_rows = 0
+    with transaction(db):
+        call_session_ids = []
+        for call_session, call_channels, recordings in call_data:
+            changed_rows += upsert_call_data(db, call_session, call_channels,
+                                             recordings)
+            call_session_ids.append(call_session.call_session_id)
+            call_sessions_count += 1
+        store_call_session_summaries(db, call_session_ids)
+        store_call_session_stats(db, call_session_ids)
+        if call_session is not None:
+            set_value('last_call_session_id',
+                      uuid_expand(call_session.call_session_id))
+    return call_session, call_sessions_count, changed_rows
 
+
+def _fetch_call_data_serial(db, last_call_session_id):
+    updated = False
     while True:
         content = zisson_api_get('XmlExport',
                                  {'LastCallSessionId': last_call_session_id})
         if not content:
             break
-        call_sessions, call_channels, recordings = parse_call_data(content)
-        if len(call_sessions) == 0:
+        call_session, call_sessions_count, changed_rows = _store_call_data(
+            db, iter_call_data(content))
+        if call_session is None:
             break
-        current_app.logger.info(f'Read {len(call_sessions)} new call sessions from zisson')
-        last_call_session_id = uuid_expand(call_sessions[-1].call_session_id)
-        set_value('last_call_session_id', last_call_session_id)
-        updated = True
-        with transaction(db):
-            db.executemany(upsert_call_sessions, call_sessions)
-            db.executemany(upsert_call_channels, call_channels)
-            db.executemany(upsert_recordings, recordings)
-        if (datetime.utcnow().timestamp()
-                - call_sessions[-1].start_timestamp
-                <= 5 * 60):
+        current_app.logger.info(f'Read {call_sessions_count} call sessions from zisson, '
+                                f'{changed_rows} rows changed')
+        updated = updated or changed_rows > 0
+        if _is_recent(call_session):
             break
+        last_call_session_id = uuid_expand(call_session.call_session_id)
+    return updated
+
+
+def _put_unless_stopped(pages: Queue, page, stop: Event) -> bool:
+    while not stop.is_set():
+        try:
+            pages.put(page, timeout=1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _prefetch_call_data(app, last_call_session_id, pages: Queue, stop: Event):
+    """fetches and parses XmlExport pages ahead of the writer
+
+    Runs in a background thread. Each parsed page is put in `pages`. The
+    last item is always an empty page marking the end, or the exception
+    that ended the thread, so the writer never waits for a page that does
+    not come.
+    """
+    end = []
+    try:
+        with app.app_context():
+            while not stop.is_set():
+                content = zisson_api_get(
+                    'XmlExport', {'LastCallSessionId': last_call_session_id})
+                page = list(iter_call_data(content)) if content else []
+                if not page or not _put_unless_stopped(pages, page, stop):
+                    return
+                call_session = page[-1][0]
+                if _is_recent(call_session):
+                    return
+                last_call_session_id = uuid_expand(call_session.call_session_id)
+    except BaseException as err:
+        end = err
+    finally:
+        _put_unless_stopped(pages, end, stop)
+
+
+def _fetch_call_data_pipelined(db, last_call_session_id, read_ahead):
+    pages = Queue(maxsize=read_ahead)
+    stop = Event()
+    Thread(target=_prefetch_call_data,
+           args=(current_app._get_current_object(),
+                 last_call_session_id, pages, stop),
+           daemon=True).start()
+    updated = False
+    try:
+        # the prefetch thread decides where to stop, and always ends with
+        # an empty page or an exception
+        while (page := pages.get()):
+            if isinstance(page, BaseException):
+                raise page
+            _, call_sessions_count, changed_rows = _store_call_data(db, page)
+            current_app.logger.info(f'Read {call_sessions_count} call sessions from zisson, '
+                                    f'{changed_rows} rows changed')
+            updated = updated or changed_rows > 0
+    finally:
+        stop.set()
+    return updated
+
+
+def fetch_call_data():
+    """fetches new call data from zisson, page by page
+
+    With FETCH_CALL_DATA_READ_AHEAD > 0, up to that many pages are fetched
+    and parsed in a background thread while the current page is written.
+    Pages are always written in order, each in its own transaction together
+    with the last_call_session_id watermark.
+    """
+    db = get_db()
+    last_call_session_id = get_value('last_call_session_id')
+    read_ahead = int(current_app.config['FETCH_CALL_DATA_READ_AHEAD'])
+    if read_ahead > 0:
+        updated = _fetch_call_data_pipelined(db, last_call_session_id, read_ahead)
+    else:
+        updated = _fetch_call_data_serial(db, last_call_session_id)
     if updated:
         send_push_updates()
 
 
+def _content_fingerprint(content: bytes) -> str:
+    return sha256(content).hexdigest()
+
+
+def _changed_rows(db, tablename, fields, rows, ignored=(), rendered=()):
+    """returns the rows that differ from what is stored in `tablename`
+
+    Rows are keyed on their first field (the primary key), and compared on
+    all fields except `ignored`. The second return value tells whether a
+    new row was added, or a field in `rendered` was changed.
+    """
+    compared = [i for i, field in enumerate(fields) if field[0] not in ignored]
+    rendered = [i for i, field in enumerate(fields) if field[0] in rendered]
+    columns = ', '.join(fields[i][0] for i in compared)
+    stored = {row[0]: tuple(row)
+              for row in db.execute(f'select {columns} from {tablename}')}
+    changed_rows, rendered_changed = [], False
+    for row in rows:
+        old_row = stored.get(row[0])
+        if old_row is None:
+            changed_rows.append(row)
+            rendered_changed = True
+        elif old_row != tuple(row[i] for i in compared):
+            changed_rows.append(row)
+            old_values = dict(zip(compared, old_row))
+            if any(old_values[i] != row[i] for i in rendered):
+                rendered_changed = True
+    return changed_rows, rendered_changed
+
+
 def fetch_contacts():
     content = zisson_api_get('GetContacts')
     if not content:
         return
+    fingerprint = _content_fingerprint(content)
+    if fingerprint == get_value('contacts_fingerprint'):
+        current_app.logger.info('Contacts unchanged in zisson')
+        return
     contacts = parse_contacts(content)
     db = get_db()
     with transaction(db):
-        db.executemany(upsert_contacts, contacts)
-    current_app.logger.info('Contacts updated from zisson')
-    send_push_updates()
+        contacts, rendered_changed = _changed_rows(
+            db, 'contacts', Contact_fields, contacts,
+            ignored=('contact_last_updated', ),
+            rendered=('first_name', 'last_name', 'pstn_number', 'gsm_number'))
+        changed_rows = db.executemany(upsert_contacts, contacts).rowcount
+        set_value('contacts_fingerprint', fingerprint)
+    current_app.logger.info(f'{changed_rows} contacts updated from zisson')
+    if rendered_changed:
+        send_push_updates()
 
 
 def fetch_customer_data():
     content = zisson_api_get('CustomerExport')
     if not content:
         return
+    fingerprint = _content_fingerprint(content)
+    if fingerprint == get_value('customer_data_fingerprint'):
+        current_app.logger.info('Customer data unchanged in zisson')
+        return
     agents, internal_phones, service_numbers = (
         parse_customer_data(content))
 
     db = get_db()
     with transaction(db):
-        db.executemany(upsert_agents, agents)
-        db.executemany(upsert_internal_phones, internal_phones)
-        db.executemany(upsert_service_numbers, service_numbers)
-    current_app.logger.info('Customer data updated from zisson')
-    send_push_updates()
+        agents, agents_changed = _changed_rows(
+            db, 'agents', Agent_fields, agents,
+            ignored=('agent_last_updated', ),
+            rendered=('agent_first_name', 'agent_last_name', 'agent_email'))
+        internal_phones, internal_phones_changed = _changed_rows(
+            db, 'internal_phones', InternalPhone_fields, internal_phones,
+            ignored=('location_last_updated', ),
+            rendered=('location_number', 'location_name',
+                      'location_description'))
+        service_numbers, service_numbers_changed = _changed_rows(
+            db, 'service_numbers', ServiceNumber_fields, service_numbers,
+            ignored=('service_number_last_updated', ),
+            rendered=('service_number', 'service_number_description'))
+        changed_rows = (
+            db.executemany(upsert_agents, agents).rowcount
+            + db.executemany(upsert_internal_phones, internal_phones).rowcount
+            + db.executemany(upsert_service_numbers, service_numbers).rowcount)
+        if agents_changed or internal_phones_changed or service_numbers_changed:
+            # summaries describe agents and service numbers, and are
+            # computed again below
+            db.execute('delete from call_session_summary')
+        set_value('customer_data_fingerprint', fingerprint)
+    current_app.logger.info(f'{changed_rows} rows of customer data updated from zisson')
+    if agents_changed or internal_phones_changed or service_numbers_changed:
+        computed = backfill_call_session_summaries()
+        current_app.logger.info(f'{computed} call session summaries computed again')
+        send_push_updates()
+
+
+AGENT_LOCATIONS_HISTORY = timedelta(hours=24) # on first fetch
+AGENT_LOCATIONS_OVERLAP = timedelta(minutes=5) # for late events
+
+
+def _api_timestamp(when: datetime) -> str:
+    return when.isoformat(timespec='seconds') + 'Z'
+
+
+def fetch_agent_locations():
+    """updates agent_locations from the logon events since the last fetch
+
+    The events are fetched from a little before the last fetch, replaying
+    an event is harmless.
+    """
+    now = datetime.utcnow()
+    if (last_fetch := get_value('agent_locations_fetched')) is None:
+        start = now - AGENT_LOCATIONS_HISTORY
+    else:
+        start = datetime.fromisoformat(last_fetch.rstrip('Z')) - AGENT_LOCATIONS_OVERLAP
+    content = zisson_api_get('AgentQueueStatusEvents',
+                             params = {
+                                 'start_date': _api_timestamp(start),
+                                 'end_date': _api_timestamp(now + timedelta(hours=24)),
+                                 'logon_events': '1',
+                             })
+    if content is None:
+        return
+    events = parse_logon_events(content)
+    db = get_db()
+    with transaction(db):
+        changed_rows = db.executemany(upsert_agent_locations, events).rowcount
+        set_value('agent_locations_fetched', _api_timestamp(now))
+    current_app.logger.info(f'{len(events)} logon events, '
+                            f'{changed_rows} agent locations updated')
 
 
 MAX_RECORDING_AGE = 60 * 60 * 24 * 7 # 1 week, in seconds
+RECORDING_RETRY_BACKOFF = 5 * 60 # seconds, doubled for each attempt
+RECORDING_RETRY_MAX = 6 * 60 * 60 # seconds
+RECORDING_SETTLE_TIME = 60 # seconds since last change, before downloading
+
+SFTP_CHUNK_SIZE = 1024 * 1024
+
+
+def _sftp_connection(config):
+    sftp_host_key = RSAKey(data=b64decode(config['ZISSON_SFTP_HOST_KEY']))
+    cnopts = pysftp.CnOpts()
+    cnopts.hostkeys.add(config['ZISSON_SFTP_HOST'],
+                        'ssh-rsa',
+                        sftp_host_key)
+    return pysftp.Connection(host=config['ZISSON_SFTP_HOST'],
+                             username=config['ZISSON_SFTP_USERNAME'],
+                             password=config['ZISSON_SFTP_PASSWORD'],
+                             cnopts=cnopts)
+
+
+def _download_recording(sftp, recording_id, remote_stat) -> int|None:
+    """downloads one recording, resuming a partial download
+
+    `remote_stat` is the recording's entry from the remote directory
+    listing. The file is written to a temporary file, renamed into place
+    when complete, and then removed from the sftp server. Returns the number
+    of bytes transferred, or None if the recording is no longer on the
+    server.
+    """
+    local_file = recording_local_file(recording_id)
+    partial_file = local_file + '.part'
+    remote_file = 'recording/' + recording_id
+    os.makedirs(os.path.dirname(local_file), mode=0o700, exist_ok=True)
+    try:
+        offset = os.path.getsize(partial_file)
+    except FileNotFoundError:
+        offset = 0
+    if offset > remote_stat.st_size:
+        offset = 0
+    try:
+        remote = sftp.open(remote_file, 'rb')
+    except FileNotFoundError:
+        return None
+    with remote, open(partial_file, 'r+b' if offset else 'wb') as local:
+        os.chmod(partial_file, 0o600)
+        local.seek(offset)
+        local.truncate()
+        remote.seek(offset)
+        remote.prefetch(remote_stat.st_size)
+        while (chunk := remote.read(SFTP_CHUNK_SIZE)):
+            local.write(chunk)
+    if (size := os.path.getsize(partial_file)) != remote_stat.st_size:
+        raise IOError(f'recording {recording_id}: got {size} of '
+                      f'{remote_stat.st_size} bytes')
+    os.utime(partial_file, (remote_stat.st_atime, remote_stat.st_mtime))
+    os.replace(partial_file, local_file)
+    sftp.remove(remote_file)
+    return size - offset
+
+
+def _recording_downloader(app, recordings: Queue, results: dict):
+    """downloads (recording id, remote stat) pairs from `recordings`
+
+    Runs in a thread, one per sftp connection. Failed downloads are retried
+    (on a new connection) up to ZISSON_SFTP_RETRIES times. The outcome for
+    each recording is stored in `results` as (DownloadState, bytes).
+    """
+    with app.app_context():
+        retries = int(app.config['ZISSON_SFTP_RETRIES'])
+        sftp = None
+        try:
+            while True:
+                try:
+                    recording_id, remote_stat = recordings.get_nowait()
+                except Empty:
+                    return
+                for attempt in range(retries + 1):
+                    try:
+                        if sftp is None:
+                            sftp = _sftp_connection(app.config)
+                        app.logger.info(f'Downloading recording {recording_id}')
+                        if (size := _download_recording(sftp, recording_id,
+                                                         remote_stat)) is None:
+                            results[recording_id] = (DownloadState.missing, 0)
+                        else:
+                            results[recording_id] = (DownloadState.downloaded, size)
+                        break
+                    except (SSHException, OSError, EOFError) as err:
+                        app.logger.warn(f'Downloading recording {recording_id} '
+                                        f'failed (attempt {attempt + 1}): {err}')
+                        results[recording_id] = (DownloadState.failed, 0)
+                        if sftp is not None:
+                            sftp.close()
+                        sftp = None
+        finally:
+            if sftp is not None:
+                sftp.close()
+
+
+def download_recordings(recordings: dict) -> dict:
+    """downloads recordings over ZISSON_SFTP_CONNECTIONS parallel connections
+
+    `recordings` maps recording id to its remote stat (from listdir_attr).
+    Returns a dict mapping recording id to its DownloadState. Recordings
+    that were never attempted (no connection could be made) are left out.
+    """
+    app = current_app._get_current_object()
+    queue = Queue()
+    for item in recordings.items():
+        queue.put(item)
+    results = {}
+    start = time.perf_counter()
+    threads = [Thread(target=_recording_downloader,
+                      args=(app, queue, results))
+               for _ in range(min(int(app.config['ZISSON_SFTP_CONNECTIONS']),
+                                  len(recordings)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    downloaded = [size for state, size in results.values()
+                  if state == DownloadState.downloaded]
+    total_bytes = sum(downloaded)
+    app.logger.info(f'Downloaded {len(downloaded)} of {len(recordings)} '
+                    f'recordings, {total_bytes / 1e6:.1f} MB in {elapsed:.1f}s '
+                    f'({total_bytes / 1e6 / max(elapsed, 1e-3):.2f} MB/s)')
+    return {recording_id: state for recording_id, (state, _) in results.items()}
+
+
+def list_remote_recordings(config) -> dict:
+    """returns a dict of recording id -> stat for the remote recording dir"""
+    with _sftp_connection(config) as sftp:
+        return {attr.filename: attr for attr in sftp.listdir_attr('recording')}
+
 
 def fetch_recordings():
+    """downloads pending recordings, and records the outcome
+
+    Only recordings in recording_downloads that are not downloaded yet, and
+    whose next_attempt has come, are considered. The remote directory is
+    listed once, and only recordings that are there, and have not changed
+    for RECORDING_SETTLE_TIME seconds, are downloaded. Recordings missing
+    on the server, or failing to download, are retried with exponential
+    backoff.
+    """
     if 'ZISSON_SFTP_PASSWORD' not in current_app.config:
         return
 
+    db = get_db()
     now = datetime.utcnow().timestamp()
     earliest_timestamp = now - MAX_RECORDING_AGE
 
-    recording_ids = list(
-        filter(
-            lambda rec_id: not os.path.exists(recording_local_file(rec_id)),
-            map(
-                lambda x: uuid_expand(x[0]),
-                get_db().execute(
-                    'select recording_id from recordings '
-                    'where start_timestamp >= ? '
-                    'and completed = 1 '
-                    'order by start_timestamp',
-                    (earliest_timestamp,)).fetchall()
-            )
-        )
-    )
-
-    if len(recording_ids) == 0:
-        return
+    results = {}
+    recording_ids = [uuid_expand(recording_id) for (recording_id,) in
+                     db.execute(select_pending_recordings,
+                                (now, earliest_timestamp)).fetchall()]
 
-    sftp_host_key = RSAKey(data=b64decode(current_app.config['ZISSON_SFTP_HOST_KEY']))
-    cnopts = pysftp.CnOpts()
-    cnopts.hostkeys.add(current_app.config['ZISSON_SFTP_HOST'],
-                        'ssh-rsa',
-                        sftp_host_key)
-    with pysftp.Connection(host=current_app.config['ZISSON_SFTP_HOST'],
-                           username=current_app.config['ZISSON_SFTP_USERNAME'],
-                           password=current_app.config['ZISSON_SFTP_PASSWORD'],
-                           cnopts=cnopts
-                           ) as sftp:
-        for recording_id in recording_ids:
-            local_file = recording_local_file(recording_id)
-            remote_file = 'recording/' + recording_id
-            if not sftp.exists(remote_file):
-                continue
-            os.makedirs(os.path.dirname(local_file), mode=0o700, exist_ok=True)
-            try:
-                current_app.logger.info(f'Downloading recording {recording_id}')
-                sftp.get(remote_file, local_file, preserve_mtime=True)
-                os.chmod(local_file, 0o600)
-                sftp.remove(remote_file)
-            except SSHException:
-                try:
-                    os.remove(local_file)
-                except FileNotFoundError:
-                    pass
+    if recording_ids:
+        try:
+            remote = list_remote_recordings(current_app.config)
+        except (SSHException, OSError, EOFError) as err:
+            current_app.logger.warn(f'Listing recordings failed: {err}')
+            remote = None
+        if remote is not None:
+            settled = now - RECORDING_SETTLE_TIME
+            downloads = {}
+            for recording_id in recording_ids:
+                if (remote_stat := remote.get(recording_id)) is None:
+                    results[recording_id] = DownloadState.missing
+                elif remote_stat.st_mtime <= settled:
+                    downloads[recording_id] = remote_stat
+            if downloads:
+                results.update(download_recordings(downloads))
+
+    with transaction(db):
+        db.executemany(update_recording_download, (
+            (state.value, now, RECORDING_RETRY_MAX, RECORDING_RETRY_BACKOFF,
+             uuid_compact(recording_id))
+            for recording_id, state in results.items()))
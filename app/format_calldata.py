@@ -1,29 +1,87 @@
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
+import json
 import math
+from threading import Lock
 
+import click
 from flask import g
+from flask.cli import with_appcontext
 
+from .archive import archived_months_between, attached_archive
+from .model.call_data import CallSessionSummary, insert_call_session_summary
 from .parse_xml import HangupReasonT
-from .db import get_db
-from .utils import format_timedelta, min_not_taken, pretty_print_phone_no, uuid_expand
+from .db import get_db, transaction
+from .utils import (
+    QUERY_BATCH_SIZE,
+    batches,
+    format_timedelta,
+    min_not_taken,
+    pretty_print_phone_no,
+    uuid_expand,
+)
 
 
 MAX_NO_ANSWER_BEFORE_WARN = 30 # seconds
 
 
-def call_channels_for(call_session_id: str):
-    if 'call_session_channels_cache' not in g:
-        g.call_session_channels_cache = {}
-    cache = g.call_session_channels_cache
-    if call_session_id not in cache:
-        call_channels = get_db().execute(
-            sql_call_channels_joined,
-            (call_session_id, )).fetchall()
-        if call_channels:
-            cache[call_session_id] = call_channels
-    return cache[call_session_id]
+def _summary_cache() -> dict:
+    if 'call_session_summary_cache' not in g:
+        g.call_session_summary_cache = {}
+    return g.call_session_summary_cache
+
+
+def _summary_from_row(row) -> CallSessionSummary:
+    summary = CallSessionSummary(*row)
+    return summary._replace(
+        incoming=None if summary.incoming is None else bool(summary.incoming),
+        answered=bool(summary.answered),
+        active=bool(summary.active))
+
+
+def load_call_sessions(call_session_ids):
+    """loads the summaries of many call sessions
+
+    Stored summaries are read with one query per QUERY_BATCH_SIZE call
+    sessions. The call sessions without one (archived, or not summarized
+    yet) have their joined call channels loaded the same way, and are
+    summarized without storing, so showing call data never writes. The
+    results are cached for the rest of the request, where
+    call_session_summary finds them.
+    """
+    db = get_db()
+    cache = _summary_cache()
+    missing = [call_session_id for call_session_id in call_session_ids
+               if call_session_id not in cache]
+    for batch in batches([call_session_id for call_session_id in missing
+                          if call_session_archive(call_session_id) is None]):
+        for row in db.execute(
+                'select * from call_session_summary where call_session_id in '
+                f'({", ".join("?" * len(batch))})', batch):
+            cache[row['call_session_id']] = _summary_from_row(row)
+    by_archive = {}
+    for call_session_id in missing:
+        if call_session_id not in cache:
+            by_archive.setdefault(call_session_archive(call_session_id),
+                                  []).append(call_session_id)
+    for archive, ids in by_archive.items():
+        if archive is None:
+            _summarize_unstored(db, 'main', ids, cache)
+        else:
+            with attached_archive(db, *archive) as schema:
+                _summarize_unstored(db, schema, ids, cache)
+
+
+def _summarize_unstored(db, schema, call_session_ids, cache):
+    for batch in batches(call_session_ids):
+        call_channels = {call_session_id: [] for call_session_id in batch}
+        for call_channel in db.execute(
+                call_channels_joined_sql(schema, len(batch)), batch):
+            call_channels[call_channel['call_session_id']].append(call_channel)
+        for call_session_id, channels in call_channels.items():
+            cache[call_session_id] = summarize_call_session(call_session_id,
+                                                            channels)
 
 
 def agent_name(call_channel) -> str:
@@ -119,8 +177,22 @@ class Row:
     cells: list
 
 
-def get_call_session_data(call_session_id):
-    call_channels = call_channels_for(call_session_id)
+# the fields of each call channel shown in the details of a call session,
+# stored with its summary so showing it needs no join of the call channels
+DETAIL_FIELDS = ('call_direction', 'end_point_class', 'service_number_id',
+                 'answered', 'active', 'hangup_reason', 'a_number', 'b_number',
+                 'call_timestamp', 'answer_timestamp', 'hangup_timestamp',
+                 'recording_id')
+
+
+def _detail_value(name, value):
+    if name == 'recording_id' and value is not None:
+        return uuid_expand(value)
+    return value
+
+
+def summarize_call_session(call_session_id, call_channels) -> CallSessionSummary|None:
+    """computes the summary of a call session from its joined call channels"""
     if len(call_channels) == 0:
         return None
 
@@ -159,30 +231,133 @@ def get_call_session_data(call_session_id):
             if call_channels[0]['call_state'] == 't':
                 no_answer_time = call_channels[0]['hangup_timestamp'] - start_time
 
+    return CallSessionSummary(
+        call_session_id = call_session_id,
+        start_time = start_time,
+        incoming = incoming,
+        answered = bool(answered),
+        active = bool(call_channels[0]['active']),
+        from_no = from_no,
+        to_no = to_no,
+        agent_info = agent_info,
+        service_info = service_info,
+        error = (HangupReasonT(call_channels[0]['hangup_reason']).name
+                 if error else None),
+        no_answer_time = (math.ceil(no_answer_time)
+                          if not answered and incoming
+                          and no_answer_time > MAX_NO_ANSWER_BEFORE_WARN
+                          else None),
+        channels = json.dumps([[_detail_value(name, call_channel[name])
+                                for name in DETAIL_FIELDS]
+                               for call_channel in call_channels],
+                              separators=(',', ':')),
+    )
+
+
+def store_call_session_summaries(db, call_session_ids) -> int:
+    """computes and stores the missing summaries among `call_session_ids`
+
+    Called in the transaction that upserted the call sessions, after the
+    triggers on call_channels removed the summaries that changed. Returns
+    the number of summaries computed.
+    """
+    computed = 0
+    for call_session_id in call_session_ids:
+        if db.execute('select 1 from call_session_summary '
+                      'where call_session_id = ?',
+                      (call_session_id, )).fetchone():
+            continue
+        summary = summarize_call_session(
+            call_session_id,
+            db.execute(sql_call_channels_joined, (call_session_id, )).fetchall())
+        if summary is not None:
+            db.execute(insert_call_session_summary, summary)
+            computed += 1
+    return computed
+
+
+def backfill_call_session_summaries() -> int:
+    """stores the missing summaries of all call sessions, returns the count
+
+    Runs in batches of QUERY_BATCH_SIZE call sessions, one transaction each.
+    """
+    db = get_db()
+    computed = 0
+    last_id = b''
+    while True:
+        batch = [row[0] for row in db.execute(
+            'select call_session_id from call_sessions '
+            'where call_session_id > ? '
+            'and call_session_id not in '
+            '    (select call_session_id from call_session_summary) '
+            'order by call_session_id limit ?',
+            (last_id, QUERY_BATCH_SIZE)).fetchall()]
+        if not batch:
+            return computed
+        with transaction(db):
+            computed += store_call_session_summaries(db, batch)
+        last_id = batch[-1]
+
+
+@click.command('backfill-summaries')
+@with_appcontext
+def cmd_backfill_summaries():
+    print(f'Computed {backfill_call_session_summaries()} call session summaries')
+
+
+def init_app(app):
+    app.cli.add_command(cmd_backfill_summaries)
+
+
+def call_session_summary(call_session_id) -> CallSessionSummary|None:
+    """returns the summary of a call session, from the cache of the request
+
+    A call session without a stored summary is summarized, but the summary
+    is not stored: that is left to the writers.
+    """
+    load_call_sessions([call_session_id])
+    return _summary_cache()[call_session_id]
+
+
+def get_call_sessions_data(call_session_ids) -> list:
+    """get_call_session_data of many call sessions, loaded in batches"""
+    load_call_sessions(call_session_ids)
+    return [get_call_session_data(call_session_id)
+            for call_session_id in call_session_ids]
+
+
+def get_call_session_data(call_session_id):
+    """returns what is shown about a call session"""
+    summary = call_session_summary(call_session_id)
+    if summary is None:
+        return None
+
     result = {
         'id': uuid_expand(call_session_id),
-        'timestamp': start_time,
-        'from_no': from_no,
-        'from_descr': lookup_number(from_no),
-        'to_no': to_no,
-        'to_descr': lookup_number(to_no),
-        'incoming': incoming,
-        'active': call_channels[0]['active'],
-        'agent_info': agent_info,
-        'details': get_call_session_data_details(call_session_id),
+        'timestamp': summary.start_time,
+        'from_no': summary.from_no,
+        'from_descr': lookup_number(summary.from_no),
+        'to_no': summary.to_no,
+        'to_descr': lookup_number(summary.to_no),
+        'incoming': summary.incoming,
+        'active': summary.active,
+        'agent_info': summary.agent_info,
+        'details': get_call_session_data_details(
+            [dict(zip(DETAIL_FIELDS, values))
+             for values in json.loads(summary.channels)]),
     }
-    if service_info:
-        result['service_info'] = service_info
-    if error:
-        result['error'] = HangupReasonT(call_channels[0]['hangup_reason']).name
-    if not answered and incoming and no_answer_time > MAX_NO_ANSWER_BEFORE_WARN:
-        result['no_answer_time'] = math.ceil(no_answer_time)
+    if summary.service_info:
+        result['service_info'] = summary.service_info
+    if summary.error:
+        result['error'] = summary.error
+    if summary.no_answer_time is not None:
+        result['no_answer_time'] = summary.no_answer_time
 
     return result
 
 
-def get_call_session_data_details(call_session_id):
-    call_channels = call_channels_for(call_session_id)
+def get_call_session_data_details(call_channels):
+    """lays out the events of the call channels (DETAIL_FIELDS dicts)"""
     if len(call_channels) == 0:
         return None
 
@@ -206,7 +381,7 @@ def get_call_session_data_details(call_session_id):
         kwargs['to_no'] = call_channel['b_number']
         kwargs['call_channel_no'] = call_channel_no
         if call_channel['recording_id'] != None:
-            kwargs['recording_id'] = uuid_expand(call_channel['recording_id'])
+            kwargs['recording_id'] = call_channel['recording_id']
 
         events.append(Event(
             timestamp = call_channel['call_timestamp'],
@@ -295,14 +470,43 @@ def get_call_session_data_details(call_session_id):
     return details
 
 
-def call_sessions_between(from_epoch, to_epoch):
-    tuple_list = get_db().execute(
-        'select call_session_id from call_sessions '
+def call_session_archive(call_session_id) -> tuple[int, int]|None:
+    """returns (year, month) of the archive holding `call_session_id`
+
+    Call sessions found in an archive by call_sessions_between are
+    remembered for the rest of the request, the others are in the main
+    database (None).
+    """
+    return g.get('call_session_archives', {}).get(call_session_id)
+
+
+def _call_sessions_in(db, schema, from_epoch, to_epoch) -> list:
+    return db.execute(
+        f'select call_session_id, start_timestamp from {schema}.call_sessions '
         'where start_timestamp >= ? '
-        'and start_timestamp < ? '
-        'order by start_timestamp desc',
+        'and start_timestamp < ?',
         (from_epoch, to_epoch)).fetchall()
-    return list(map(lambda x: x[0], tuple_list))
+
+
+def call_sessions_between(from_epoch, to_epoch):
+    """returns the ids of the call sessions in [from, to), newest first
+
+    The archives overlapping the range are attached one at a time.
+    """
+    db = get_db()
+    if 'call_session_archives' not in g:
+        g.call_session_archives = {}
+    call_sessions = [(start_timestamp, call_session_id)
+                     for call_session_id, start_timestamp
+                     in _call_sessions_in(db, 'main', from_epoch, to_epoch)]
+    for year, month in archived_months_between(from_epoch, to_epoch):
+        with attached_archive(db, year, month) as schema:
+            rows = _call_sessions_in(db, schema, from_epoch, to_epoch)
+        for call_session_id, start_timestamp in rows:
+            g.call_session_archives[call_session_id] = (year, month)
+            call_sessions.append((start_timestamp, call_session_id))
+    call_sessions.sort(reverse=True)
+    return [call_session_id for _, call_session_id in call_sessions]
 
 
 def newest_call_session_ids(seconds = 8 * 60 * 60):
@@ -314,7 +518,7 @@ def newest_call_session_ids(seconds = 8 * 60 * 60):
     return list(map(lambda x: x[0], tuple_list))
 
 
-sql_call_channels_joined = """\
+_sql_call_channels_joined = """\
 select
     call_channels.*,
     agents.agent_first_name agent_first_name,
@@ -326,7 +530,7 @@ select
     from_service_numbers.service_number_description
         from_service_number_description,
     recordings.recording_id
-from call_channels
+from {schema}.call_channels call_channels
 left outer join agents
     on agents.agent_id = call_channels.login_id
 left outer join internal_phones
@@ -335,61 +539,79 @@ left outer join service_numbers service_numbers
     on service_numbers.service_number_id = call_channels.service_number_id
 left outer join service_numbers from_service_numbers
     on from_service_numbers.service_number = call_channels.a_number
-left outer join recordings
+left outer join {schema}.recordings recordings
     on recordings.call_session_id = call_channels.call_session_id
     and recordings.call_channel_id = call_channels.call_channel_id
     and recordings.completed
-where call_channels.call_session_id = ?
-order by call_timestamp
+where call_channels.call_session_id {condition}
+order by call_channels.call_timestamp, call_channels.call_channel_id
 """
 
 
+def call_channels_joined_sql(schema='main', count=None) -> str:
+    """returns sql_call_channels_joined, reading call data from `schema`
+
+    With `count`, the query takes that many call session ids instead of one.
+    """
+    condition = '= ?' if count is None else f'in ({", ".join("?" * count)})'
+    return _sql_call_channels_joined.format(schema=schema, condition=condition)
+
+
+sql_call_channels_joined = call_channels_joined_sql()
+
+
+class NumberDirectory:
+    """number -> display name, of every known number, built in bulk
+
+    Service numbers take precedence over internal phones, which take
+    precedence over contacts, and within each the first row found wins, as
+    in a lookup query per number. As every known number is in the
+    directory, a number not in it is known to be unknown, without a query.
+    """
+    def __init__(self, db, version):
+        self.version = version
+        names = {}
+        for number, description in db.execute(
+                "select service_number, service_number_description "
+                "from service_numbers where service_number is not null "
+                "order by service_number_id"):
+            names.setdefault(number, description)
+        for number, name, description in db.execute(
+                "select location_number, location_name, location_description "
+                "from internal_phones where location_number is not null "
+                "order by location_id"):
+            names.setdefault(number, name or description or 'Agent phone')
+        for pstn_number, gsm_number, first_name, last_name in db.execute(
+                "select pstn_number, gsm_number, first_name, last_name "
+                "from contacts order by contact_id"):
+            name = ' '.join(filter(None, (first_name, last_name)))
+            for number in (pstn_number, gsm_number):
+                if number is not None:
+                    names.setdefault(number, name)
+        self.names = names
+
+
+_number_directory = None
+_number_directory_lock = Lock()
+
+
+def number_directory() -> NumberDirectory:
+    """returns this process' number directory, rebuilt if outdated
+
+    The version is checked once per app context.
+    """
+    global _number_directory
+    if 'number_directory' not in g:
+        db = get_db()
+        version = db.execute("select value from keyvalue "
+                             "where key = 'number_directory_version'").fetchone()
+        version = version[0] if version else None
+        with _number_directory_lock:
+            if _number_directory is None or _number_directory.version != version:
+                _number_directory = NumberDirectory(db, version)
+            g.number_directory = _number_directory
+    return g.number_directory
+
+
 def lookup_number(number) -> str:
-    if 'number_lookup_cache' not in g:
-        g.number_lookup_cache = {}
-    cache = g.number_lookup_cache
-    if number in cache:
-        return cache[number]
-    db = get_db()
-    service_number = db.execute(
-        "select service_number_description "
-        "from service_numbers "
-        "where service_number = ?",
-        (number,)).fetchone()
-    if service_number:
-        (description,) = service_number
-        cache[number] = description
-        return cache[number]
-    internal_phone = db.execute(
-        "select location_name, location_description "
-        "from internal_phones "
-        "where location_number = ?",
-        (number,)).fetchone()
-    if internal_phone:
-        name, description = internal_phone
-        if name:
-            cache[number] = name
-        elif description:
-            cache[number] = description
-        else:
-            cache[number] = 'Agent phone'
-        return cache[number]
-    contacts = db.execute(
-        "select first_name, last_name "
-        "from contacts "
-        "where pstn_number = ? "
-        "or gsm_number = ?",
-        (number, number)).fetchone()
-    if contacts:
-        first_name, last_name = contacts
-        if first_name and last_name:
-            cache[number] = first_name + ' ' + last_name
-            return cache[number]
-        if first_name:
-            cache[number] = first_name
-            return cache[number]
-        if last_name:
-            cache[number] = last_name
-            return cache[number]
-    cache[number] = None
-    return ''
+    return number_directory().names.get(number, '')
@@ -0,0 +1,210 @@
+"""Bulk import of saved XmlExport pages, for reloading history
+
+  flask import-history [--jobs N] [--batch N] [--no-watermark] [--offline] PATH...
+
+Each PATH is an XmlExport page (optionally gzipped), or a directory of
+them. Pages are imported in order of file name, so they should sort in the
+order they were exported.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import os
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .db import get_db, transaction
+from .format_calldata import (
+    backfill_call_session_summaries,
+    store_call_session_summaries,
+)
+from .model.call_data import upsert_call_data
+from .model.keyvalue import get_value, set_value
+from .parse_xml import iter_call_data
+from .stats import backfill_stats, store_call_session_stats
+from .utils import uuid_compact, uuid_expand
+
+
+IMPORTED_TABLES = ('call_sessions', 'call_channels', 'recordings')
+
+
+def _page_files(paths) -> list[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if name.endswith(('.xml', '.xml.gz')))
+        else:
+            files.append(path)
+    return files
+
+
+def _parse_page(filename) -> list[tuple]:
+    """parses one page, in a worker process
+
+    Returns plain tuples, as the record namedtuples can not be pickled.
+    """
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as fp:
+        return [(tuple(call_session),
+                 [tuple(call_channel) for call_channel in call_channels],
+                 [tuple(recording) for recording in recordings])
+                for call_session, call_channels, recordings in iter_call_data(fp)]
+
+
+def _drop_secondary_indexes(db) -> list[str]:
+    """drops the indexes of the imported tables, returns their sql"""
+    placeholders = ', '.join('?' * len(IMPORTED_TABLES))
+    indexes = db.execute(
+        "select name, sql from sqlite_master "
+        f"where type = 'index' and tbl_name in ({placeholders}) "
+        "and sql is not null", IMPORTED_TABLES).fetchall()
+    with transaction(db):
+        for name, _ in indexes:
+            db.execute(f'drop index {name}')
+    return [sql for _, sql in indexes]
+
+
+def _create_indexes(db, indexes):
+    with transaction(db):
+        for sql in indexes:
+            db.execute(sql)
+
+
+def _parsed_pages(executor, files, window):
+    """yields (filename, page) in order, parsing up to `window` pages ahead
+
+    Parsed pages waiting for the writer are held in memory, so their
+    number is bounded.
+    """
+    files = iter(files)
+    in_flight = deque()
+    for filename in files:
+        in_flight.append((filename, executor.submit(_parse_page, filename)))
+        if len(in_flight) >= window:
+            break
+    while in_flight:
+        filename, future = in_flight.popleft()
+        page = future.result()
+        if (filename_ahead := next(files, None)) is not None:
+            in_flight.append((filename_ahead,
+                              executor.submit(_parse_page, filename_ahead)))
+        yield filename, page
+
+
+def _start_timestamp(db, call_session_id) -> float|None:
+    row = db.execute('select start_timestamp from call_sessions '
+                     'where call_session_id = ?', (call_session_id, )).fetchone()
+    return row[0] if row else None
+
+
+def _move_watermark(db, call_session_id):
+    """sets last_call_session_id to `call_session_id`, unless that is older
+
+    Importing older history must not move the watermark back, or the next
+    fetch_call_data downloads everything since again.
+    """
+    if (current := get_value('last_call_session_id')) is not None:
+        current_start = _start_timestamp(db, uuid_compact(current))
+        if (current_start is not None
+                and current_start >= _start_timestamp(db, call_session_id)):
+            return
+    set_value('last_call_session_id', uuid_expand(call_session_id))
+
+
+def _store_derived(db, call_session_ids):
+    """stores the summaries and statistics of the imported call sessions"""
+    store_call_session_summaries(db, call_session_ids)
+    store_call_session_stats(db, call_session_ids)
+
+
+def import_history(files, jobs=None, batch=20000, watermark=True,
+                   offline=False):
+    """imports XmlExport pages from `files`, returns (sessions, rows)
+
+    The summaries and statistics of the call sessions are stored with each
+    batch. With `offline`, the indexes of the call data tables are dropped
+    during the import and rebuilt after, which is faster, but leaves
+    readers of the database without them meanwhile. The summaries and
+    statistics are then backfilled after the indexes are rebuilt.
+    """
+    db = get_db()
+    start = time.perf_counter()
+    call_sessions, rows, changed_rows, pending = 0, 0, 0, 0
+    last_call_session_id = None
+    call_session_ids = []
+    indexes = _drop_secondary_indexes(db) if offline else []
+    jobs = jobs or os.cpu_count() or 1
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            db.execute('begin immediate')
+            try:
+                for filename, page in _parsed_pages(executor, files, 2 * jobs):
+                    for call_session, call_channels, recordings in page:
+                        changed_rows += upsert_call_data(db, call_session,
+                                                         call_channels, recordings)
+                        rows += 1 + len(call_channels) + len(recordings)
+                        last_call_session_id = call_session[0]
+                        call_session_ids.append(last_call_session_id)
+                        call_sessions += 1
+                        pending += 1
+                    if pending >= batch:
+                        if not offline:
+                            _store_derived(db, call_session_ids)
+                        db.commit()
+                        db.execute('begin immediate')
+                        call_session_ids, pending = [], 0
+                    current_app.logger.info(f'Imported {filename}: {len(page)} call sessions')
+                if not offline:
+                    _store_derived(db, call_session_ids)
+                if watermark and last_call_session_id is not None:
+                    _move_watermark(db, last_call_session_id)
+            except:
+                db.rollback()
+                raise
+            else:
+                db.commit()
+    finally:
+        if indexes:
+            index_start = time.perf_counter()
+            _create_indexes(db, indexes)
+            current_app.logger.info(f'Rebuilt {len(indexes)} indexes in '
+                                    f'{time.perf_counter() - index_start:.1f}s')
+    if offline:
+        backfill_call_session_summaries()
+        backfill_stats()
+    elapsed = time.perf_counter() - start
+    current_app.logger.info(
+        f'Imported {call_sessions} call sessions, {rows} rows '
+        f'({changed_rows} changed) in {elapsed:.1f}s, '
+        f'{rows / max(elapsed, 1e-3):.0f} rows/s')
+    return call_sessions, rows
+
+
+@click.command('import-history')
+@click.argument('paths', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=True))
+@click.option('--jobs', type=int, default=None,
+              help='parser processes (default: number of cpus)')
+@click.option('--batch', type=int, default=20000,
+              help='call sessions per transaction')
+@click.option('--watermark/--no-watermark', default=True,
+              help='move last_call_session_id forward to the last imported session')
+@click.option('--offline', is_flag=True,
+              help='drop indexes while importing (faster), '
+                   'only while the app is stopped')
+@with_appcontext
+def cmd_import_history(paths, jobs, batch, watermark, offline):
+    if not (files := _page_files(paths)):
+        raise click.ClickException('No XmlExport pages found')
+    call_sessions, rows = import_history(files, jobs, batch, watermark, offline)
+    click.echo(f'Imported {call_sessions} call sessions ({rows} rows) '
+               f'from {len(files)} pages')
+
+
+def init_app(app):
+    app.cli.add_command(cmd_import_history)
@@ -5,14 +5,13 @@ from flask_wtf.csrf import ValidationError, validate_csrf
 
 from .extensions import socketio
 from .auth import login_require_role
-from .format_calldata import get_call_session_data, newest_call_session_ids
+from .format_calldata import get_call_sessions_data, newest_call_session_ids
 
 
 def push_updates(recipient='live_view_clients'):
     html = render_template(
         'call_sessions.html',
-        call_sessions=map(get_call_session_data,
-                          newest_call_session_ids()))
+        call_sessions=get_call_sessions_data(newest_call_session_ids()))
     socketio.emit('replace_content', html, to=recipient)
 
 
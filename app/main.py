@@ -2,11 +2,14 @@
 
 
 from datetime import datetime
+import os
 
 from flask import (
     Blueprint,
+    abort,
     current_app,
     flash,
+    jsonify,
     redirect,
     render_template,
     request,
@@ -16,11 +19,17 @@ from flask import (
 from flask_wtf import FlaskForm
 from wtforms import SubmitField
 
+from .archive import earliest_archived_timestamp, find_recording
 from .auth import login_require_role
 from .db import get_db
 from .fetch import fetch_contacts, fetch_customer_data
-from .format_calldata import call_sessions_between, get_call_session_data
+from .format_calldata import (
+    call_sessions_between,
+    get_call_session_data,
+    get_call_sessions_data,
+)
 from .model.call_data import recording_local_file
+from .model.contacts import search_contacts
 from .utils import uuid_compact
 
 
@@ -65,7 +74,8 @@ def my_ip_address():
 @login_require_role('agent')
 def history_view():
     lowest_timestamp = (
-        get_db()
+        earliest_archived_timestamp()
+        or get_db()
         .execute('select min(start_timestamp) from call_sessions')
         .fetchone()[0]
         or datetime.utcnow().timestamp()
@@ -87,7 +97,7 @@ def history_view():
     except (ValueError, AssertionError, TypeError):
         to_epoch = from_epoch + 24*60*60
 
-    data = list(map(get_call_session_data, call_sessions_between(from_epoch, to_epoch)))
+    data = get_call_sessions_data(call_sessions_between(from_epoch, to_epoch))
     return render_template('history.html',
                            call_sessions=data,
                            from_epoch=from_epoch,
@@ -140,20 +150,41 @@ def view_contacts():
         fetch_contacts()
         flash('Contacts updated')
         return redirect(url_for('main.view_contacts'))
-    contacts = [dict(row) for row
-                in get_db().execute("select * from contacts").fetchall()]
+    query = request.args.get('q', '')
+    contacts, next_cursor = search_contacts(get_db(), query,
+                                            request.args.get('after'))
     return render_template('contacts.html',
                            form=form,
-                           contacts=contacts)
+                           query=query,
+                           contacts=[dict(row) for row in contacts],
+                           next_cursor=next_cursor)
+
+
+@main.route('/contacts/search')
+@login_require_role('admin')
+def search_contacts_json():
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+    except ValueError:
+        limit = 50
+    contacts, next_cursor = search_contacts(get_db(),
+                                            request.args.get('q', ''),
+                                            request.args.get('after'),
+                                            limit)
+    return jsonify(contacts=[dict(row) for row in contacts],
+                   next=next_cursor)
 
 
 @main.route('/play_recording/<recording_id>', methods=['GET', 'POST'])
 @login_require_role('recording')
 def play_recording(recording_id):
-    recording_start, recording_end = get_db().execute(
-        'select start_timestamp, stop_timestamp from recordings '
-        'where recording_id = ? and completed = 1',
-        (uuid_compact(recording_id),)).fetchone()
+    try:
+        recording = find_recording(uuid_compact(recording_id))
+    except ValueError: # not a uuid
+        recording = None
+    if recording is None or not os.path.isfile(recording_local_file(recording_id)):
+        abort(404) # unknown, not downloaded yet, or pruned
+    recording_start, recording_end = recording
     return render_template('modal_player.html',
                            recording_start = recording_start,
                            recording_end = recording_end,
@@ -163,7 +194,9 @@ def play_recording(recording_id):
 @main.route('/recording/<recording_id>')
 @login_require_role('recording')
 def recording(recording_id):
+    if not os.path.isfile(path := recording_local_file(recording_id)):
+        abort(404) # not downloaded yet, or pruned
     current_app.logger.info(f"Downloading recording {recording_id}")
-    return send_file(recording_local_file(recording_id),
+    return send_file(path,
                      mimetype='audio/mpeg',
                      attachment_filename=f"{recording_id}.mp3")
@@ -1 +1 @@
-from . import call_data, contacts, customer_data, keyvalue, utils
+from . import call_data, call_stats, contacts, customer_data, keyvalue, number_directory, utils
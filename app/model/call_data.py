@@ -1,12 +1,20 @@
+from base64 import b85decode
+from enum import Enum
 import os
 from flask import current_app
 
-from ..db import add_to_schema
-from .utils import generate_create_table_sql, generate_namedtuple, generate_upsert_sql
+from ..db import add_migration, add_to_schema, execute_script
+from ..utils import uuid_compact
+from .utils import (
+    generate_create_table_sql,
+    generate_namedtuple,
+    generate_upsert_sql,
+    rebuild_table,
+)
 
 
 CallSession_fields = (
-    ('call_session_id', str  , 'text primary key'),
+    ('call_session_id', bytes, 'blob primary key'),
     ('start_timestamp', float, 'real not null'   ),
     ('end_timestamp'  , float, 'real'            ))
 
@@ -26,12 +34,13 @@ on call_sessions (start_timestamp);""")
 
 upsert_call_sessions = generate_upsert_sql('call_sessions',
                                       CallSession_fields,
-                                      ('call_session_id', ))
+                                      ('call_session_id', ),
+                                      skip_unchanged=True)
 
 
 CallChannel_fields = (
-    ('call_channel_id'  , str  , 'text primary key'),
-    ('call_session_id'  , str  , 'text references call_sessions (call_session_id) on delete cascade'),
+    ('call_channel_id'  , bytes, 'blob primary key'),
+    ('call_session_id'  , bytes, 'blob references call_sessions (call_session_id) on delete cascade'),
     ('call_direction'   , str  , 'text not null'    ),
     ('a_number'         , int  , 'integer'          ),
     ('b_number'         , int  , 'integer'          ),
@@ -64,13 +73,14 @@ on call_channels (call_session_id);""")
 
 upsert_call_channels = generate_upsert_sql('call_channels',
                                           CallChannel_fields,
-                                          ('call_channel_id',))
+                                          ('call_channel_id',),
+                                          skip_unchanged=True)
 
 
 Recording_fields = (
-    ('recording_id', str, 'text primary key'),
-    ('call_session_id', str, 'text references call_sessions (call_session_id) on delete cascade'),
-    ('call_channel_id', str, 'text references call_channels (call_channel_id) on delete cascade'),
+    ('recording_id', bytes, 'blob primary key'),
+    ('call_session_id', bytes, 'blob references call_sessions (call_session_id) on delete cascade'),
+    ('call_channel_id', bytes, 'blob references call_channels (call_channel_id) on delete cascade'),
     ('start_timestamp', float, 'real not null'),
     ('stop_timestamp', float, 'real'),
     ('completed', int, 'integer'), # RecordingStatus=Completed (&& Active=false ?)
@@ -90,7 +100,212 @@ on recordings (start_timestamp);""")
 
 upsert_recordings = generate_upsert_sql('recordings',
                                         Recording_fields,
-                                        ('recording_id',))
+                                        ('recording_id',),
+                                        skip_unchanged=True)
+
+
+CallSessionSummary_fields = (
+    ('call_session_id', bytes    , 'blob primary key references call_sessions (call_session_id) on delete cascade'),
+    ('start_time'     , float    , 'real'   ),
+    ('incoming'       , bool|None, 'integer'),
+    ('answered'       , bool     , 'integer'),
+    ('active'         , bool     , 'integer'),
+    ('from_no'        , int|None , 'integer'),
+    ('to_no'          , int|None , 'integer'),
+    ('agent_info'     , str|None , 'text'   ),
+    ('service_info'   , str|None , 'text'   ),
+    ('error'          , str|None , 'text'   ),
+    ('no_answer_time' , int|None , 'integer'),
+    ('channels'       , str      , 'text'   ), # json, see format_calldata
+)
+
+
+CallSessionSummary = generate_namedtuple('CallSessionSummary',
+                                         CallSessionSummary_fields)
+
+
+# a summary is removed when any of its call channels or recordings change,
+# and is computed again by format_calldata.store_call_session_summaries
+call_session_summary_schema = add_to_schema(
+    generate_create_table_sql('call_session_summary',
+                              CallSessionSummary_fields) + """
+create trigger call_channels_summary_insert_trg
+after insert on call_channels
+begin
+    delete from call_session_summary
+    where call_session_id = new.call_session_id;
+end;
+create trigger call_channels_summary_update_trg
+after update on call_channels
+begin
+    delete from call_session_summary
+    where call_session_id in (old.call_session_id, new.call_session_id);
+end;
+create trigger call_channels_summary_delete_trg
+after delete on call_channels
+begin
+    delete from call_session_summary
+    where call_session_id = old.call_session_id;
+end;
+create trigger recordings_summary_insert_trg
+after insert on recordings
+begin
+    delete from call_session_summary
+    where call_session_id = new.call_session_id;
+end;
+create trigger recordings_summary_update_trg
+after update on recordings
+begin
+    delete from call_session_summary
+    where call_session_id in (old.call_session_id, new.call_session_id);
+end;""")
+
+
+insert_call_session_summary = generate_upsert_sql(
+    'call_session_summary',
+    CallSessionSummary_fields,
+    ('call_session_id', ))
+
+
+class DownloadState(Enum):
+    pending = 'pending'
+    downloaded = 'downloaded'
+    missing = 'missing' # not (yet) on the sftp server
+    failed = 'failed'
+    pruned = 'pruned' # removed by retention
+
+
+RecordingDownload_fields = (
+    ('recording_id'     , bytes, 'blob primary key references recordings (recording_id) on delete cascade'),
+    ('download_state'   , str  , "text not null default 'pending'"),
+    ('download_attempts', int  , 'integer not null default 0'),
+    ('next_attempt'     , float, 'real not null default 0'),
+)
+
+
+recording_downloads_schema = add_to_schema(
+    generate_create_table_sql('recording_downloads',
+                              RecordingDownload_fields) + """
+create index recording_downloads_state_idx
+on recording_downloads (download_state, next_attempt);
+create trigger recordings_completed_insert_trg
+after insert on recordings when new.completed
+begin
+    insert or ignore into recording_downloads (recording_id)
+    values (new.recording_id);
+end;
+create trigger recordings_completed_update_trg
+after update of completed on recordings when new.completed
+begin
+    insert or ignore into recording_downloads (recording_id)
+    values (new.recording_id);
+end;""")
+
+
+select_pending_recordings = """\
+select recordings.recording_id
+from recording_downloads
+join recordings using (recording_id)
+where recording_downloads.download_state not in ('downloaded', 'pruned')
+and recording_downloads.next_attempt <= ?
+and recordings.start_timestamp >= ?
+order by recordings.start_timestamp"""
+
+
+update_recording_download = """\
+update recording_downloads set
+    download_state = ?,
+    download_attempts = download_attempts + 1,
+    next_attempt = ? + min(?, ? * (1 << min(download_attempts, 30)))
+where recording_id = ?"""
+
+
+update_recording_pruned = """\
+update recording_downloads set download_state = 'pruned'
+where recording_id = ?"""
+
+
+def upsert_call_data(db, call_session, call_channels, recordings) -> int:
+    """upserts one call session, returns the number of rows changed"""
+    return (db.execute(upsert_call_sessions, call_session).rowcount
+            + db.executemany(upsert_call_channels, call_channels).rowcount
+            + db.executemany(upsert_recordings, recordings).rowcount)
+
+
+def _migrate_uuid_blobs(db):
+    """converts ids from base85 text to 16 byte blobs"""
+    db.create_function('uuid_blob', 1,
+                       lambda text: None if text is None else b85decode(text),
+                       deterministic=True)
+    rebuild_table(db, 'call_sessions', CallSession_fields,
+                  'select uuid_blob(call_session_id), start_timestamp, '
+                  'end_timestamp from call_sessions')
+    call_channel_columns = ', '.join(
+        f'uuid_blob({name})' if type_ is bytes else name
+        for name, type_, _ in CallChannel_fields)
+    rebuild_table(db, 'call_channels', CallChannel_fields,
+                  f'select {call_channel_columns} from call_channels')
+    rebuild_table(db, 'recordings', Recording_fields,
+                  'select uuid_blob(recording_id), uuid_blob(call_session_id), '
+                  'uuid_blob(call_channel_id), start_timestamp, '
+                  'stop_timestamp, completed from recordings')
+
+
+add_migration(20261018, _migrate_uuid_blobs)
+
+
+def _local_recording_ids() -> list[bytes]:
+    """returns the ids of the recordings stored locally, in one walk"""
+    storage = os.path.join(current_app.instance_path, 'recordings')
+    recording_ids = []
+    for _, _, filenames in os.walk(storage):
+        for filename in filenames:
+            try:
+                recording_ids.append(uuid_compact(filename))
+            except ValueError: # not a recording
+                pass
+    return recording_ids
+
+
+def _migrate_recording_downloads(db):
+    """fills recording_downloads, from the recordings already downloaded
+
+    The local files are looked at this once, afterwards the table is
+    trusted.
+    """
+    execute_script(db, recording_downloads_schema)
+    db.execute("insert into recording_downloads (recording_id) "
+               "select recording_id from recordings where completed")
+    db.executemany("update recording_downloads "
+                   "set download_state = 'downloaded' "
+                   "where recording_id = ?",
+                   ((recording_id, ) for recording_id in _local_recording_ids()))
+
+
+add_migration(20261019, _migrate_recording_downloads)
+
+
+add_migration(20261021,
+              lambda db: execute_script(db, call_session_summary_schema))
+
+
+def _migrate_summary_channels(db):
+    """recreates the summaries with the call channels shown in details
+
+    The summaries are derived data, computed again by flask
+    backfill-summaries.
+    """
+    execute_script(db, """\
+drop trigger if exists call_channels_summary_insert_trg;
+drop trigger if exists call_channels_summary_update_trg;
+drop trigger if exists call_channels_summary_delete_trg;
+drop trigger if exists recordings_summary_insert_trg;
+drop trigger if exists recordings_summary_update_trg;
+drop table call_session_summary;""")
+    execute_script(db, call_session_summary_schema)
+
+
+add_migration(20261025, _migrate_summary_channels)
 
 
 def recording_local_file(recording_id):
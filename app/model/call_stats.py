@@ -0,0 +1,96 @@
+from ..db import add_migration, add_to_schema, execute_script
+from .utils import generate_create_table_sql, generate_namedtuple
+
+
+# 0 stands for no service number / no agent, as primary keys of a table
+# without rowid can not be null
+CallSessionStats_fields = (
+    ('call_session_id'   , bytes, 'blob primary key' ),
+    ('hour'              , int  , 'integer not null' ), # start, epoch
+    ('service_number_id' , int  , 'integer not null' ),
+    ('login_id'          , int  , 'integer not null' ), # answering agent
+    ('incoming'          , int  , 'integer not null' ),
+    ('answered'          , int  , 'integer not null' ),
+    ('abandoned'         , int  , 'integer not null' ),
+    ('outgoing'          , int  , 'integer not null' ),
+    ('wait_time'         , float, 'real not null'    ),
+    ('talk_time'         , float, 'real not null'    ),
+    ('outgoing_talk_time', float, 'real not null'    ))
+
+
+CallSessionStats = generate_namedtuple('CallSessionStats',
+                                       CallSessionStats_fields)
+
+
+STATS_COUNTERS = tuple(name for name, _, _ in CallSessionStats_fields[4:])
+
+
+_counter_types = tuple((name, sql.split()[0])
+                       for name, _, sql in CallSessionStats_fields[4:])
+
+_add_counters = ', '.join(f'{name} = {name} + excluded.{name}'
+                          for name in STATS_COUNTERS)
+_subtract_counters = ', '.join(f'{name} = {name} - old.{name}'
+                               for name in STATS_COUNTERS)
+
+
+# call_session_stats holds the statistics of each closed call session, and
+# its triggers keep the hourly rollups in call_stats_hourly up to date.
+# Statistics are removed when a call channel changes, and computed again by
+# stats.store_call_session_stats. They are not removed with the call
+# session, so the rollups keep covering archived and expired call data.
+call_stats_schema = add_to_schema(
+    generate_create_table_sql('call_session_stats', CallSessionStats_fields)
+    + f"""
+create table call_stats_hourly (
+    hour integer not null,
+    service_number_id integer not null,
+    login_id integer not null,
+    {', '.join(f'{name} {type_} not null'
+               for name, type_ in _counter_types)},
+    primary key (hour, service_number_id, login_id)) without rowid;
+create trigger call_session_stats_insert_trg
+after insert on call_session_stats
+when new.incoming + new.outgoing > 0
+begin
+    insert into call_stats_hourly
+    values (new.hour, new.service_number_id, new.login_id,
+            {', '.join(f'new.{name}' for name in STATS_COUNTERS)})
+    on conflict (hour, service_number_id, login_id) do update set
+        {_add_counters};
+end;
+create trigger call_session_stats_delete_trg
+after delete on call_session_stats
+when old.incoming + old.outgoing > 0
+begin
+    update call_stats_hourly set {_subtract_counters}
+    where hour = old.hour
+    and service_number_id = old.service_number_id
+    and login_id = old.login_id;
+    delete from call_stats_hourly
+    where hour = old.hour
+    and service_number_id = old.service_number_id
+    and login_id = old.login_id
+    and incoming = 0 and outgoing = 0;
+end;
+create trigger call_channels_stats_insert_trg
+after insert on call_channels
+begin
+    delete from call_session_stats
+    where call_session_id = new.call_session_id;
+end;
+create trigger call_channels_stats_update_trg
+after update on call_channels
+begin
+    delete from call_session_stats
+    where call_session_id in (old.call_session_id, new.call_session_id);
+end;""")
+
+
+insert_call_session_stats = (
+    f"insert or ignore into call_session_stats "
+    f"({', '.join(name for name, _, _ in CallSessionStats_fields)}) "
+    f"values ({', '.join('?' for _ in CallSessionStats_fields)})")
+
+
+add_migration(20261024, lambda db: execute_script(db, call_stats_schema))
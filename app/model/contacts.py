@@ -1,4 +1,8 @@
-from ..db import add_to_schema
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import json
+import re
+
+from ..db import add_migration, add_to_schema, execute_script
 from .utils import (
     generate_create_table_sql,
     generate_namedtuple,
@@ -36,5 +40,112 @@ create index contacts_gsm_number_idx on contacts (gsm_number);
 upsert_contacts = generate_upsert_sql(
     'contacts',
     Contact_fields,
-    ('contact_id',)
-)
+    ('contact_id',),
+    skip_unchanged=True)
+
+
+# full text search over contacts, rowid = contact_id. Phone numbers are
+# indexed as digits, with and without the Norwegian country code, so that
+# a prefix of either finds them.
+_contacts_fts_values = """\
+    values (new.contact_id,
+            trim(coalesce(new.first_name, '') || ' ' || coalesce(new.last_name, '')),
+            new.company, new.department, new.title, new.email,
+            trim(coalesce(new.pstn_number, '') || ' ' || coalesce(new.gsm_number, '')
+                 || ' ' || iif(new.pstn_number like '47%', substr(new.pstn_number, 3), '')
+                 || ' ' || iif(new.gsm_number like '47%', substr(new.gsm_number, 3), '')));"""
+
+
+contacts_fts_schema = add_to_schema(f"""\
+create virtual table contacts_fts using fts5 (
+    name, company, department, title, email, numbers,
+    tokenize = 'unicode61 remove_diacritics 2');
+create index contacts_sort_idx
+on contacts (coalesce(last_name, ''), coalesce(first_name, ''), contact_id);
+create trigger contacts_fts_insert_trg after insert on contacts
+begin
+    insert into contacts_fts (rowid, name, company, department, title, email, numbers)
+{_contacts_fts_values}
+end;
+create trigger contacts_fts_update_trg after update on contacts
+begin
+    delete from contacts_fts where rowid = old.contact_id;
+    insert into contacts_fts (rowid, name, company, department, title, email, numbers)
+{_contacts_fts_values}
+end;
+create trigger contacts_fts_delete_trg after delete on contacts
+begin
+    delete from contacts_fts where rowid = old.contact_id;
+end;""")
+
+
+def _migrate_contacts_fts(db):
+    execute_script(db, contacts_fts_schema)
+    db.execute('update contacts set contact_id = contact_id') # fill contacts_fts
+
+
+add_migration(20261022, _migrate_contacts_fts)
+
+
+def fts_query(text: str) -> str|None:
+    """turns user input into an fts5 query, every word is a prefix
+
+    Words that look like (parts of) a phone number are joined, and only
+    match phone numbers.
+
+    >>> fts_query('ola 912 34')
+    'numbers : "91234"* AND "ola"*'
+    >>> fts_query('Nordmann AS')
+    '"Nordmann"* AND "AS"*'
+    >>> fts_query('  ') is None
+    True
+    """
+    words = text.split()
+    numbers = [word for word in words if re.fullmatch(r'\+?[\d-]+', word)]
+    digits = re.sub(r'\D', '', ''.join(numbers))
+    terms = [f'numbers : "{digits}"*'] if digits else []
+    terms += ['"' + word.replace('"', '""') + '"*'
+              for word in words if word not in numbers]
+    return ' AND '.join(terms) or None
+
+
+def encode_cursor(contact) -> str:
+    """returns an opaque keyset cursor, pointing after `contact`"""
+    key = [contact['last_name'] or '', contact['first_name'] or '',
+           contact['contact_id']]
+    return urlsafe_b64encode(json.dumps(key).encode()).decode(encoding='ascii')
+
+
+def decode_cursor(cursor: str) -> list|None:
+    try:
+        last_name, first_name, contact_id = json.loads(urlsafe_b64decode(cursor))
+        return [str(last_name), str(first_name), int(contact_id)]
+    except (ValueError, TypeError):
+        return None
+
+
+def search_contacts(db, text='', cursor=None, limit=50) -> tuple[list, str|None]:
+    """returns a page of contacts matching `text`, sorted by name
+
+    Pages are selected by keyset: `cursor` is the cursor returned with the
+    previous page. Returns the contacts, and the cursor of the next page
+    (None on the last page).
+    """
+    where, params = [], []
+    if (query := fts_query(text or '')) is not None:
+        where.append('contact_id in (select rowid from contacts_fts '
+                     'where contacts_fts match ?)')
+        params.append(query)
+    if cursor and (key := decode_cursor(cursor)) is not None:
+        where.append("(coalesce(last_name, ''), coalesce(first_name, ''), contact_id)"
+                     " > (?, ?, ?)")
+        params += key
+    contacts = db.execute(
+        'select * from contacts '
+        + ('where ' + ' and '.join(where) + ' ' if where else '')
+        + "order by coalesce(last_name, ''), coalesce(first_name, ''), contact_id "
+        'limit ?',
+        (*params, limit + 1)).fetchall()
+    if len(contacts) > limit:
+        return contacts[:limit], encode_cursor(contacts[limit - 1])
+    return contacts, None
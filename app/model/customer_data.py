@@ -1,4 +1,4 @@
-from ..db import add_to_schema
+from ..db import add_migration, add_to_schema, execute_script
 from .utils import (
     generate_create_table_sql,
     generate_namedtuple,
@@ -29,7 +29,8 @@ on internal_phones (location_number);""")
 upsert_internal_phones = generate_upsert_sql(
     'internal_phones',
     InternalPhone_fields,
-    ('location_id', ))
+    ('location_id', ),
+    skip_unchanged=True)
 
 
 ServiceNumber_fields = (
@@ -52,7 +53,8 @@ on service_numbers (service_number);
 upsert_service_numbers = generate_upsert_sql(
     'service_numbers',
     ServiceNumber_fields,
-    ('service_number_id', ))
+    ('service_number_id', ),
+    skip_unchanged=True)
 
 
 Agent_fields = (
@@ -73,4 +75,43 @@ add_to_schema(generate_create_table_sql('agents',
 upsert_agents = generate_upsert_sql(
     'agents',
     Agent_fields,
-    ('agent_id', ))
+    ('agent_id', ),
+    skip_unchanged=True)
+
+
+AgentLocation_fields = (
+    ('agent_id'       , int     , 'integer primary key'),
+    ('location_id'    , int|None, 'integer'            ),
+    ('logged_on'      , bool    , 'integer not null'   ),
+    ('event_timestamp', str     , 'text not null'      ),
+)
+
+
+AgentLocation = generate_namedtuple('AgentLocation', AgentLocation_fields)
+
+
+agent_locations_schema = add_to_schema(
+    generate_create_table_sql('agent_locations', AgentLocation_fields))
+
+
+# logon events may be seen more than once, and out of order
+upsert_agent_locations = generate_upsert_sql(
+    'agent_locations',
+    AgentLocation_fields,
+    ('agent_id', )) + (
+        " where excluded.event_timestamp > agent_locations.event_timestamp"
+        " or excluded.event_timestamp = agent_locations.event_timestamp"
+        " and (excluded.location_id is not agent_locations.location_id"
+        " or excluded.logged_on is not agent_locations.logged_on)")
+
+
+select_agent_phone = """\
+select internal_phones.location_number
+from agents
+join agent_locations using (agent_id)
+join internal_phones using (location_id)
+where agents.agent_email = ?
+and agent_locations.logged_on"""
+
+
+add_migration(20261020, lambda db: execute_script(db, agent_locations_schema))
@@ -0,0 +1,36 @@
+from ..db import add_migration, add_to_schema, execute_script
+
+
+# number_directory_version in keyvalue is bumped whenever a number or its
+# description changes, so each process knows when to rebuild its
+# directory (see format_calldata.number_directory)
+_bump_version = """\
+    insert into keyvalue (key, value) values ('number_directory_version', 1)
+    on conflict (key) do update set value = value + 1;"""
+
+
+_watched_columns = {
+    'service_numbers': 'service_number, service_number_description',
+    'internal_phones': 'location_number, location_name, location_description',
+    'contacts': 'first_name, last_name, pstn_number, gsm_number',
+}
+
+
+number_directory_schema = add_to_schema('\n'.join(
+    f"""\
+create trigger {table}_directory_insert_trg after insert on {table}
+begin
+{_bump_version}
+end;
+create trigger {table}_directory_update_trg after update of {columns} on {table}
+begin
+{_bump_version}
+end;
+create trigger {table}_directory_delete_trg after delete on {table}
+begin
+{_bump_version}
+end;"""
+    for table, columns in _watched_columns.items()))
+
+
+add_migration(20261023, lambda db: execute_script(db, number_directory_schema))
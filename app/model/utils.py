@@ -12,13 +12,42 @@ def generate_create_table_sql(name, fields):
     return f"""create table {name} ({columns}) without rowid;"""
 
 
-def generate_upsert_sql(tablename, fields, primary=()):
+def generate_upsert_sql(tablename, fields, primary=(), skip_unchanged=False):
+    """generates an upsert statement for `tablename`
+
+    With `skip_unchanged`, a conflicting row is only updated if some column
+    actually changed, so the number of changed rows (cursor.rowcount) tells
+    whether anything happened.
+    """
     field_names = tuple(map(lambda x: x[0], fields))
     remaining_fields = tuple(filter(
         lambda x: x not in primary,
         field_names))
-    return " ".join(chain(
+    sql = " ".join(chain(
         [f"insert into {tablename} ({', '.join(field_names)})",
          f"values({', '.join(['?' for _ in field_names])})",
          f"on conflict ({', '.join(primary)}) do update set",],
         [", ".join(f"{f} = excluded.{f}" for f in remaining_fields)]))
+    if skip_unchanged:
+        sql += " where " + " or ".join(
+            f"{tablename}.{f} is not excluded.{f}" for f in remaining_fields)
+    return sql
+
+
+def rebuild_table(db, name, fields, select_sql):
+    """recreates table `name` with new `fields`, within a migration
+
+    The new table is filled by `select_sql`, which reads from the old table.
+    Indexes and triggers of the old table are recreated.
+    """
+    schema_sql = [sql for (sql,) in db.execute(
+        "select sql from sqlite_master "
+        "where tbl_name = ? and type in ('index', 'trigger') "
+        "and sql is not null",
+        (name,))]
+    db.execute(generate_create_table_sql(f'{name}_new', fields))
+    db.execute(f'insert into {name}_new {select_sql}')
+    db.execute(f'drop table {name}')
+    db.execute(f'alter table {name}_new rename to {name}')
+    for sql in schema_sql:
+        db.execute(sql)
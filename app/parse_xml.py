@@ -1,35 +1,47 @@
 from datetime import datetime
 from enum import Enum
+from io import BytesIO
+from typing import BinaryIO
 
 import lxml.etree
 
-from .model.call_data import CallChannel, CallSession, Recording
-from .model.contacts import Contact
-from .model.customer_data import Agent, InternalPhone, ServiceNumber
-from .utils import e164_to_int, iso_datetime_to_epoch, str_to_bool, uuid_compact, uuid_expand
+from .model.call_data import (
+    CallChannel,
+    CallChannel_fields,
+    CallSession,
+    CallSession_fields,
+    Recording,
+    Recording_fields,
+)
+from .model.contacts import Contact, Contact_fields
+from .model.customer_data import (
+    Agent,
+    Agent_fields,
+    AgentLocation,
+    AgentLocation_fields,
+    InternalPhone,
+    InternalPhone_fields,
+    ServiceNumber,
+    ServiceNumber_fields,
+)
+from .utils import (
+    e164_to_int,
+    iso_datetime_to_epoch,
+    iso_datetimes_to_epochs,
+    str_to_bool,
+    uuid_compact,
+    uuid_expand,
+)
 
 
 def parse_contacts(xmldata: bytes):
     contacts = []
     data = lxml.etree.fromstring(xmldata)
     now = datetime.utcnow().timestamp()
-    for contact in data.xpath('Contacts/Contact'):
-        if (id := subint(contact, 'ContactId')):
-            contacts.append(Contact(
-                contact_id = id,
-                first_name = subtext(contact, 'FirstName'),
-                last_name = subtext(contact, 'LastName'),
-                email = subtext(contact, 'Email'),
-                pstn_number = subphone(contact, 'Number'),
-                gsm_number = subphone(contact, 'GsmNumber'),
-                company = subtext(contact, 'Company'),
-                comments = subtext(contact, 'Comments'),
-                title = subtext(contact, 'Title'),
-                department = subtext(contact, 'Department'),
-                address = subtext(contact, 'Address'),
-                editable = subbool(contact, 'Editable'),
-                contact_last_updated = now
-            ))
+    for node in data.xpath('Contacts/Contact'):
+        contact = extract_contact(node, contact_last_updated = now)
+        if contact.contact_id:
+            contacts.append(contact)
     return contacts
 
 
@@ -37,69 +49,31 @@ def parse_customer_data(xmldata: bytes):
     agents, internal_phones, service_numbers = [], [], []
     data = lxml.etree.fromstring(xmldata)
     now = datetime.utcnow().timestamp()
-    for login in data.xpath('Logins/Login'):
-        if (id := subint(login, 'LoginId')):
-            agents.append(Agent(agent_id = id,
-                                agent_first_name = subtext(login, 'Firstname'),
-                                agent_last_name = subtext(login, 'LastName'),
-                                agent_email = subtext(login, 'Email'),
-                                agent_last_updated = now,
-                                ))
-    for location in data.xpath('Locations/Location'):
-        if (id := subint(location, 'LocationId')):
-            internal_phones.append(InternalPhone(
-                location_id = id,
-                location_number = (subphone(location, 'FixedNumber')
-                          or subphone(location, 'PstnNumber')
-                          or subphone(location, 'GsmNumber')),
-                location_name = subtext(location, 'LocationName'),
-                location_description = subtext(location, 'Description'),
-                location_last_updated = now,
-            ))
-    for service_number in data.xpath('ServiceNumbers/ServiceNumber'):
-        if (id := subint(service_number, 'ServiceNumberId')):
-            service_numbers.append(ServiceNumber(
-                service_number_id = id,
-                service_number = subphone(service_number, 'Number'),
-                service_number_description = subtext(service_number, 'Description'),
-                service_number_last_updated = now,
-            ))
+    for node in data.xpath('Logins/Login'):
+        agent = extract_agent(node, agent_last_updated = now)
+        if agent.agent_id:
+            agents.append(agent)
+    for node in data.xpath('Locations/Location'):
+        internal_phone = extract_internal_phone(node, location_last_updated = now)
+        if internal_phone.location_id:
+            internal_phones.append(internal_phone)
+    for node in data.xpath('ServiceNumbers/ServiceNumber'):
+        service_number = extract_service_number(node,
+                                                service_number_last_updated = now)
+        if service_number.service_number_id:
+            service_numbers.append(service_number)
     return agents, internal_phones, service_numbers
 
 
-def subtext(node: lxml.etree, sub: str) -> str|None:
-    if len(subnodes := node.xpath(sub)) == 0:
-        return None
-    if subnodes[0].text is None:
-        return None
-    return subnodes[0].text.strip()
-
-
-def subuuid(node: lxml.etree, sub: str) -> str:
-    return uuid_compact(subtext(node, sub) or 'failure')
-
-
-def subtimestamp(node: lxml.etree, sub: str) -> float|None:
-    if (text := subtext(node, sub)) is None:
-        return None
-    return iso_datetime_to_epoch(text)
-
-
-def subbool(node: lxml.etree, sub: str) -> int|None:
-    if (text := subtext(node, sub)) is None:
-        return None
-    return str_to_bool(text)
-
-
-def subint(node: lxml.etree, sub: str) -> int|None:
-    if (text := subtext(node, sub)) is None:
-        return None
-    return int(text)
-
-def subphone(node: lxml.etree, sub: str) -> int|None:
-    if (text := subtext(node, sub)) is None:
-        return None
-    return e164_to_int(text)
+def parse_logon_events(xmldata: bytes) -> list[AgentLocation]:
+    """returns the logon events of AgentQueueStatusEvents, oldest first"""
+    data = lxml.etree.fromstring(xmldata)
+    events = [extract_agent_location(node) for node in
+              data.xpath('/AgentQueueStatusEvents/LogonEvents/LogonEvent')]
+    events = [event for event in events
+              if event.agent_id and event.event_timestamp]
+    events.sort(key = lambda event: event.event_timestamp)
+    return events
 
 
 class CallDirectionT(Enum):
@@ -135,89 +109,343 @@ class HangupReasonT(Enum):
     failed = 'f'
 
 
-def subenum(node: lxml.etree, enumtype) -> str|None:
-    sub = enumtype.__name__[:-1]
-    if (text := subtext(node, sub)) is None:
-        return None
-    return enumtype[text.lower()].value
-
-
-service_number_id_xpath_query = """\
-ServiceNumbers /
-ServiceNumber /
-CallChannelId [ normalize-space(text()) = $call_channel_id ] /
-parent :: node() /
-Number [ normalize-space(text()) = $phone_number ] /
-parent :: node() /
-ServiceNumberId"""
+def optional(convert):
+    """wraps `convert`, so that missing text is converted to None"""
+    def convert_optional(text: str|None):
+        if text is None:
+            return None
+        return convert(text)
+    return convert_optional
+
+
+def enum_tag(enumtype) -> str:
+    return enumtype.__name__[:-1]
+
+
+def enum_converter(enumtype):
+    return optional(lambda text: enumtype[text.lower()].value)
+
+
+def text_converter(text: str|None) -> str|None:
+    return text
+
+
+def uuid_converter(text: str|None) -> str:
+    return uuid_compact(text or 'failure')
+
+
+int_converter = optional(int)
+bool_converter = optional(str_to_bool)
+phone_converter = optional(e164_to_int)
+timestamp_converter = optional(iso_datetime_to_epoch)
+timestamp_converter.batch = iso_datetimes_to_epochs
+
+
+def generate_extractor(record_type, fields, tags, extra=()):
+    """generates a function that extracts a `record_type` from an element
+
+    `fields` is one of the `*_fields` tuples from app.model, and `tags` maps
+    each field name to a tuple (xml_tag, converter). xml_tag may also be a
+    tuple of tags, in which case the first converted value that is true is
+    used, like `a or b or c`. The fields listed in `extra` are not read from
+    XML, they are passed as keyword arguments to the generated function.
+
+    The generated function visits the children of the element only once,
+    and uses the stripped text of the first child with a given tag. Its
+    `all` attribute extracts the records of many elements at once, using
+    the `batch` variant of a converter where there is one.
+    """
+    field_names = [field[0] for field in fields]
+    if (unknown := (set(tags) | set(extra)) - set(field_names)):
+        raise ValueError(f"{record_type.__name__}: unknown fields {unknown}")
+    if (unmapped := set(field_names) - set(tags) - set(extra)):
+        raise ValueError(f"{record_type.__name__}: no xml tag for {unmapped}")
+
+    plan = []
+    wanted_tags = set()
+    for name in field_names:
+        if name in extra:
+            plan.append((None, None, name))
+            continue
+        xml_tags, convert = tags[name]
+        if isinstance(xml_tags, str):
+            xml_tags = (xml_tags, )
+        wanted_tags.update(xml_tags)
+        plan.append((xml_tags, convert, name))
+
+    def texts_of(node: lxml.etree._Element) -> dict:
+        texts = {}
+        for child in node:
+            tag = child.tag
+            if tag in wanted_tags and tag not in texts:
+                text = child.text
+                texts[tag] = text.strip() if text is not None else None
+        return texts
+
+    def extract(node: lxml.etree._Element, **kwargs):
+        texts = texts_of(node)
+        values = []
+        for xml_tags, convert, name in plan:
+            if xml_tags is None:
+                values.append(kwargs.get(name))
+                continue
+            for xml_tag in xml_tags:
+                if (value := convert(texts.get(xml_tag))):
+                    break
+            values.append(value)
+        return record_type._make(values)
+
+    def extract_all(nodes, **kwargs) -> list:
+        """extracts a record from each of `nodes`
+
+        A tag whose converter has a `batch` variant is converted for all
+        the nodes at once.
+        """
+        all_texts = [texts_of(node) for node in nodes]
+        batched = {xml_tag: convert.batch([texts.get(xml_tag) for texts in all_texts])
+                   for xml_tags, convert, _ in plan
+                   if hasattr(convert, 'batch')
+                   for xml_tag in xml_tags}
+        records = []
+        for node_no, texts in enumerate(all_texts):
+            values = []
+            for xml_tags, convert, name in plan:
+                if xml_tags is None:
+                    values.append(kwargs.get(name))
+                    continue
+                for xml_tag in xml_tags:
+                    value = (batched[xml_tag][node_no] if xml_tag in batched
+                             else convert(texts.get(xml_tag)))
+                    if value:
+                        break
+                values.append(value)
+            records.append(record_type._make(values))
+        return records
+
+    extract.all = extract_all
+    extract.__name__ = f"extract_{record_type.__name__}"
+    return extract
+
+
+Contact_tags = {
+    'contact_id' : ('ContactId' , int_converter  ),
+    'first_name' : ('FirstName' , text_converter ),
+    'last_name'  : ('LastName'  , text_converter ),
+    'email'      : ('Email'     , text_converter ),
+    'pstn_number': ('Number'    , phone_converter),
+    'gsm_number' : ('GsmNumber' , phone_converter),
+    'company'    : ('Company'   , text_converter ),
+    'comments'   : ('Comments'  , text_converter ),
+    'title'      : ('Title'     , text_converter ),
+    'department' : ('Department', text_converter ),
+    'address'    : ('Address'   , text_converter ),
+    'editable'   : ('Editable'  , bool_converter ),
+}
+
+extract_contact = generate_extractor(Contact, Contact_fields, Contact_tags,
+                                     extra=('contact_last_updated', ))
+
+
+Agent_tags = {
+    'agent_id'        : ('LoginId'  , int_converter ),
+    'agent_first_name': ('Firstname', text_converter),
+    'agent_last_name' : ('LastName' , text_converter),
+    'agent_email'     : ('Email'    , text_converter),
+}
+
+extract_agent = generate_extractor(Agent, Agent_fields, Agent_tags,
+                                   extra=('agent_last_updated', ))
+
+
+InternalPhone_tags = {
+    'location_id'         : ('LocationId', int_converter),
+    'location_number'     : (('FixedNumber', 'PstnNumber', 'GsmNumber'),
+                             phone_converter),
+    'location_name'       : ('LocationName', text_converter),
+    'location_description': ('Description' , text_converter),
+}
+
+extract_internal_phone = generate_extractor(
+    InternalPhone, InternalPhone_fields, InternalPhone_tags,
+    extra=('location_last_updated', ))
+
+
+ServiceNumber_tags = {
+    'service_number_id'         : ('ServiceNumberId', int_converter  ),
+    'service_number'            : ('Number'         , phone_converter),
+    'service_number_description': ('Description'    , text_converter ),
+}
+
+extract_service_number = generate_extractor(
+    ServiceNumber, ServiceNumber_fields, ServiceNumber_tags,
+    extra=('service_number_last_updated', ))
+
+
+AgentLocation_tags = {
+    'agent_id'       : ('LoginId'           , int_converter ),
+    'location_id'    : ('Userid'            , int_converter ),
+    'logged_on'      : ('EventName'         , lambda text: int(text == 'QueueLogon')),
+    'event_timestamp': ('ActionTimeStampUtc', text_converter),
+}
+
+extract_agent_location = generate_extractor(AgentLocation, AgentLocation_fields,
+                                            AgentLocation_tags)
+
+
+CallSession_tags = {
+    'call_session_id': ('CallSessionId' , uuid_converter     ),
+    'start_timestamp': ('StartTimestamp', timestamp_converter),
+    'end_timestamp'  : ('EndTimestamp'  , timestamp_converter),
+}
+
+extract_call_session = generate_extractor(CallSession, CallSession_fields,
+                                          CallSession_tags)
+
+
+CallChannel_tags = {
+    'call_channel_id'  : ('CallChannelId'           , uuid_converter               ),
+    'call_direction'   : (enum_tag(CallDirectionT)  , enum_converter(CallDirectionT)),
+    'a_number'         : ('ANumber'                 , phone_converter              ),
+    'b_number'         : ('BNumber'                 , phone_converter              ),
+    'end_point_class'  : (enum_tag(EndPointClassT)  , enum_converter(EndPointClassT)),
+    'call_state'       : (enum_tag(CallStateT)      , enum_converter(CallStateT)   ),
+    'active'           : ('Active'                  , bool_converter               ),
+    'answered'         : ('Answered'                , bool_converter               ),
+    'hangup_by'        : (enum_tag(HangupByT)       , enum_converter(HangupByT)    ),
+    'hangup_reason'    : (enum_tag(HangupReasonT)   , enum_converter(HangupReasonT)),
+    'call_timestamp'   : ('CallTimestamp'           , timestamp_converter          ),
+    'ringing_timestamp': ('RingingTimestamp'        , timestamp_converter          ),
+    'answer_timestamp' : ('AnswerTimestamp'         , timestamp_converter          ),
+    'hangup_timestamp' : ('HangupTimestamp'         , timestamp_converter          ),
+    'login_id'         : ('LoginId'                 , int_converter                ),
+    'location_id'      : ('LocationId'              , int_converter                ),
+    'device_id'        : ('DeviceId'                , int_converter                ),
+}
+
+extract_call_channel = generate_extractor(
+    CallChannel, CallChannel_fields, CallChannel_tags,
+    extra=('call_session_id', 'service_number_id'))
+
+
+Recording_tags = {
+    'recording_id'   : ('RecordingId'    , uuid_converter),
+    'call_channel_id': ('CallChannelId'  , uuid_converter),
+    'start_timestamp': ('StartTimestamp' , timestamp_converter),
+    'stop_timestamp' : ('StopTimestamp'  , timestamp_converter),
+    'completed'      : ('RecordingStatus', lambda text: int(text == 'Completed')),
+}
+
+extract_recording = generate_extractor(Recording, Recording_fields,
+                                       Recording_tags,
+                                       extra=('call_session_id', ))
+
+
+def normalize_space(text: str|None) -> str:
+    return ' '.join((text or '').split())
+
+
+def service_number_index(call_session: lxml.etree._Element) -> dict:
+    """maps (call_channel_id, phone_number) to service number for a session
+
+    Built once per <CallSession> from its <ServiceNumbers> block. Keys are
+    the whitespace normalized texts of <CallChannelId> and <Number>, values
+    are the text of the first <ServiceNumberId> in document order.
+    """
+    index = {}
+    for service_numbers in call_session.iterchildren('ServiceNumbers'):
+        for service_number in service_numbers.iterchildren('ServiceNumber'):
+            service_number_ids = list(
+                service_number.iterchildren('ServiceNumberId'))
+            if not service_number_ids:
+                continue
+            numbers = [normalize_space(number.text) for number
+                       in service_number.iterchildren('Number')]
+            for call_channel_id in service_number.iterchildren('CallChannelId'):
+                call_channel_id = normalize_space(call_channel_id.text)
+                for number in numbers:
+                    index.setdefault((call_channel_id, number),
+                                     service_number_ids[0].text)
+    return index
 
 
-def get_service_number_id(call_session: lxml.etree._Element,
+def get_service_number_id(service_numbers: dict,
                       call_channel_id: str,
                       phone_number: int|None) -> int|None:
     if not phone_number:
         return
-    service_number_id_nodes = call_session.xpath(
-        service_number_id_xpath_query,
-        call_channel_id = uuid_expand(call_channel_id),
-        phone_number = "+" + str(phone_number),
-    )
-    if len(service_number_id_nodes) >= 1:
-        return int(service_number_id_nodes[0].text)
+    key = (uuid_expand(call_channel_id), "+" + str(phone_number))
+    if key in service_numbers:
+        return int(service_numbers[key])
     return None
 
 
+def parse_call_session(call_session: lxml.etree._Element,
+                       call_channel_sessions: dict):
+    """parses one <CallSession> element
+
+    Returns a tuple (call_session, call_channels, recordings) for this call
+    session only. `call_channel_sessions` maps call_channel_id to
+    call_session_id for every call channel parsed so far, it is updated with
+    the call channels of this session and used to match recordings to call
+    channels.
+    """
+    session = extract_call_session(call_session)
+    call_session_id = session.call_session_id
+    service_numbers = service_number_index(call_session)
+    session_call_channels, session_recordings = [], []
+    for call_channel in extract_call_channel.all(
+            call_session.xpath('CallChannels/CallChannel'),
+            call_session_id = call_session_id):
+        if (service_number_id := get_service_number_id(
+                service_numbers,
+                call_channel.call_channel_id,
+                call_channel.b_number)) is not None:
+            call_channel = call_channel._replace(
+                service_number_id = service_number_id)
+        session_call_channels.append(call_channel)
+    for call_channel in session_call_channels:
+        call_channel_sessions.setdefault(call_channel.call_channel_id,
+                                         call_session_id)
+    for recording in extract_recording.all(
+            call_session.xpath('RecordingSessions/RecordingSession')):
+        if recording.call_channel_id not in call_channel_sessions:
+            continue
+        session_recordings.append(recording._replace(
+            call_session_id = call_channel_sessions[recording.call_channel_id]))
+    return session, session_call_channels, session_recordings
+
+
+def iter_call_data(xmldata: bytes|BinaryIO):
+    """streaming variant of `parse_call_data`
+
+    Yields a tuple (call_session, call_channels, recordings) for each
+    <CallSession>, as soon as it has been read. Elements already processed
+    are cleared, so only one call session is kept in memory at a time.
+    `xmldata` is either the raw bytes or a binary file-like object.
+
+    Malformed input raises `lxml.etree.XMLSyntaxError` (a `SyntaxError`),
+    possibly after some call sessions have been yielded.
+    """
+    if isinstance(xmldata, bytes):
+        xmldata = BytesIO(xmldata)
+    call_channel_sessions = {}
+    for _, call_session in lxml.etree.iterparse(xmldata,
+                                                events=('end',),
+                                                tag='CallSession'):
+        yield parse_call_session(call_session, call_channel_sessions)
+        call_session.clear()
+        while call_session.getprevious() is not None:
+            del call_session.getparent()[0]
+
+
 def parse_call_data(xmldata: bytes):
     call_sessions, call_channels, recordings = [], [], []
+    call_channel_sessions = {}
     data = lxml.etree.fromstring(xmldata)
     for call_session in data.xpath('CallSession'):
-        call_session_id = subuuid(call_session, 'CallSessionId')
-        call_sessions.append(CallSession(
-            call_session_id = call_session_id,
-            start_timestamp = subtimestamp(call_session, 'StartTimestamp'),
-            end_timestamp = subtimestamp(call_session, 'EndTimestamp'),
-        ))
-        for call_channel in call_session.xpath('CallChannels/CallChannel'):
-            call_channel_id = subuuid(call_channel, 'CallChannelId')
-            a_number = subphone(call_channel, 'ANumber')
-            b_number = subphone(call_channel, 'BNumber')
-            call_channels.append(CallChannel(
-                call_channel_id = call_channel_id,
-                call_session_id = call_session_id,
-                call_direction = subenum(call_channel, CallDirectionT),
-                a_number = a_number,
-                b_number = b_number,
-                end_point_class = subenum(call_channel, EndPointClassT),
-                call_state = subenum(call_channel, CallStateT),
-                active = subbool(call_channel, 'Active'),
-                answered = subbool(call_channel, 'Answered'),
-                hangup_by = subenum(call_channel, HangupByT),
-                hangup_reason = subenum(call_channel, HangupReasonT),
-                call_timestamp = subtimestamp(call_channel, 'CallTimestamp'),
-                ringing_timestamp = subtimestamp(call_channel, 'RingingTimestamp'),
-                answer_timestamp = subtimestamp(call_channel, 'AnswerTimestamp'),
-                hangup_timestamp = subtimestamp(call_channel, 'HangupTimestamp'),
-                login_id = subint(call_channel, 'LoginId'),
-                location_id = subint(call_channel, 'LocationId'),
-                device_id = subint(call_channel, 'DeviceId'),
-                service_number_id = get_service_number_id(
-                    call_session, call_channel_id, b_number),
-            ))
-        for recording in call_session.xpath('RecordingSessions/RecordingSession'):
-            call_channel_id = subuuid(recording, 'CallChannelId')
-            for call_channel in call_channels:
-                if call_channel.call_channel_id == call_channel_id:
-                    break
-            else:
-                continue
-            recordings.append(Recording(
-                recording_id = subuuid(recording, 'RecordingId'),
-                call_session_id = call_channel.call_session_id,
-                call_channel_id = call_channel_id,
-                start_timestamp = subtimestamp(recording, 'StartTimestamp'),
-                stop_timestamp = subtimestamp(recording, 'StopTimestamp'),
-                completed = int(subtext(recording, 'RecordingStatus') == 'Completed')
-            ))
-
-
+        session, session_call_channels, session_recordings = (
+            parse_call_session(call_session, call_channel_sessions))
+        call_sessions.append(session)
+        call_channels.extend(session_call_channels)
+        recordings.extend(session_recordings)
     return call_sessions, call_channels, recordings
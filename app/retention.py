@@ -0,0 +1,166 @@
+"""Retention: deletes expired data, and gives the space back to the disk
+
+Each policy deletes rows older than a configured number of days, in
+batches of RETENTION_BATCH_SIZE rows, one short transaction per batch,
+so the write lock is never held for long. A value of 0 days keeps the
+data forever. Freed pages are then returned to the file system with
+incremental vacuum steps.
+"""
+
+from datetime import datetime
+import os
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .archive import archive_file, archived_months, month_end
+from .db import get_db, transaction
+from .model.call_data import update_recording_pruned
+from .utils import uuid_compact
+
+
+# table, primary key, timestamp column, config key for the age in days
+RETENTION_POLICIES = (
+    ('call_sessions', 'call_session_id', 'start_timestamp', 'RETENTION_CALL_DATA_DAYS'),
+    ('blocked_ip_addr', 'ip_address', 'last_failed_attempt', 'RETENTION_BLOCKED_IP_DAYS'),
+)
+
+VACUUM_STEP_PAGES = 1000
+
+
+def _cutoff(config_key) -> float|None:
+    if (days := float(current_app.config[config_key])) <= 0:
+        return None
+    return datetime.utcnow().timestamp() - days * 24 * 60 * 60
+
+
+def delete_in_batches(db, table, key, column, cutoff, batch_size) -> int:
+    """deletes rows of `table` with `column` < `cutoff`, returns the count"""
+    deleted = 0
+    while True:
+        with transaction(db):
+            count = db.execute(
+                f'delete from {table} where {key} in '
+                f'(select {key} from {table} where {column} < ? limit ?)',
+                (cutoff, batch_size)).rowcount
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+def _prune_archives(cutoff) -> int:
+    """removes the archives of months that ended before `cutoff`"""
+    freed = 0
+    for year, month in archived_months():
+        if month_end(year, month) <= cutoff:
+            filename = archive_file(year, month)
+            freed += os.path.getsize(filename)
+            os.remove(filename)
+            current_app.logger.info(f'Removed archive {filename}')
+    return freed
+
+
+def _mark_pruned(db, recording_ids):
+    with transaction(db):
+        db.executemany(update_recording_pruned,
+                       ((recording_id, ) for recording_id in recording_ids))
+
+
+def _prune_recordings(db, cutoff, batch_size) -> tuple[int, int]:
+    """removes local recording files modified before `cutoff`
+
+    Their downloads are marked as pruned, so they are not downloaded again.
+    Returns the number of files and bytes removed.
+    """
+    files, freed = 0, 0
+    pruned = []
+    storage = os.path.join(current_app.instance_path, 'recordings')
+    for dirpath, _, filenames in os.walk(storage):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            stat = os.stat(path)
+            if stat.st_mtime < cutoff:
+                os.remove(path)
+                files += 1
+                freed += stat.st_size
+                try:
+                    pruned.append(uuid_compact(filename))
+                except ValueError: # not a recording
+                    continue
+                if len(pruned) >= batch_size:
+                    _mark_pruned(db, pruned)
+                    pruned = []
+    _mark_pruned(db, pruned)
+    return files, freed
+
+
+def _database_size(db) -> int:
+    return (db.execute('pragma page_count').fetchone()[0]
+            * db.execute('pragma page_size').fetchone()[0])
+
+
+def incremental_vacuum(db) -> int:
+    """returns free pages to the file system, returns the bytes reclaimed
+
+    Each step holds the write lock only briefly. A database created before
+    auto_vacuum=incremental was the default must first be converted with
+    flask enable-incremental-vacuum, until then nothing is reclaimed.
+    """
+    if db.execute('pragma auto_vacuum').fetchone()[0] != 2: # incremental
+        current_app.logger.warning('Retention: database space is not reclaimed, '
+                                   'run flask enable-incremental-vacuum')
+        return 0
+    size_before = _database_size(db)
+    while db.execute('pragma freelist_count').fetchone()[0] > 0:
+        # db.execute steps the pragma once, freeing a single page, while
+        # executescript runs it to the end (outside of any transaction here)
+        db.executescript(f'pragma incremental_vacuum({VACUUM_STEP_PAGES})')
+    return size_before - _database_size(db)
+
+
+@click.command('enable-incremental-vacuum')
+@with_appcontext
+def cmd_enable_incremental_vacuum():
+    """converts the database to auto_vacuum=incremental, with a full vacuum
+
+    The vacuum rewrites the whole database, and holds an exclusive lock
+    meanwhile, so run this while the app and scheduler are stopped.
+    """
+    db = get_db()
+    if db.execute('pragma auto_vacuum').fetchone()[0] == 2:
+        print('Database already uses auto_vacuum=incremental')
+        return
+    start = time.perf_counter()
+    db.execute('pragma auto_vacuum = incremental')
+    db.execute('vacuum')
+    print(f'Converted database to auto_vacuum=incremental '
+          f'in {time.perf_counter() - start:.1f}s')
+
+
+def init_app(app):
+    app.cli.add_command(cmd_enable_incremental_vacuum)
+
+
+def apply_retention():
+    """deletes data past its retention time, and reclaims the space"""
+    db = get_db()
+    batch_size = int(current_app.config['RETENTION_BATCH_SIZE'])
+    for table, key, column, config_key in RETENTION_POLICIES:
+        if (cutoff := _cutoff(config_key)) is None:
+            continue
+        deleted = delete_in_batches(db, table, key, column, cutoff, batch_size)
+        current_app.logger.info(f'Retention: deleted {deleted} rows from {table}')
+
+    if (cutoff := _cutoff('RETENTION_CALL_DATA_DAYS')) is not None:
+        if (freed := _prune_archives(cutoff)):
+            current_app.logger.info(f'Retention: reclaimed {freed} bytes of archives')
+
+    if (cutoff := _cutoff('RETENTION_RECORDING_DAYS')) is not None:
+        files, freed = _prune_recordings(db, cutoff, batch_size)
+        current_app.logger.info(f'Retention: removed {files} recordings, '
+                                f'reclaimed {freed} bytes')
+
+    reclaimed = incremental_vacuum(db)
+    current_app.logger.info(f'Retention: reclaimed {reclaimed} bytes of database')
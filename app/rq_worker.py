@@ -9,6 +9,7 @@ To use with rq add to rq command line the arguments
 
 from rq.worker import Worker
 from . import create_app
+from .zisson_api import log_api_latency
 
 
 _app = create_app(minimal_app = True)
@@ -20,3 +21,9 @@ class FlaskWorker(Worker):
         with _app.app_context():
             return super().work(*args, **kwargs)
 
+    def perform_job(self, *args, **kwargs):
+        try:
+            return super().perform_job(*args, **kwargs)
+        finally:
+            log_api_latency()
+
@@ -11,7 +11,10 @@ if __name__ == "__main__":
     import schedule
     import time
 
-    from .fetch import fetch_call_data, fetch_customer_data, fetch_contacts, fetch_recordings
+    from .archive import archive_call_data
+    from .format_calldata import backfill_call_session_summaries
+    from .fetch import fetch_agent_locations, fetch_call_data, fetch_customer_data, fetch_contacts, fetch_recordings
+    from .retention import apply_retention
     from .jobs import enqueue, redis_wait_ready
     from . import create_app
 
@@ -31,10 +34,15 @@ if __name__ == "__main__":
         redis_wait_ready()
 
     rq_enqueue_with_app_context(fetch_call_data)
+    rq_enqueue_with_app_context(fetch_agent_locations)()
+    rq_enqueue_with_app_context(backfill_call_session_summaries)()
+    schedule.every(1).minutes.do(rq_enqueue_with_app_context(fetch_agent_locations))
     schedule.every(2).minutes.do(rq_enqueue_with_app_context(fetch_call_data))
     schedule.every(2).minutes.do(rq_enqueue_with_app_context(fetch_recordings))
     schedule.every(7).hours.do(rq_enqueue_with_app_context(fetch_customer_data))
     schedule.every(7).hours.do(rq_enqueue_with_app_context(fetch_contacts))
+    schedule.every(24).hours.do(rq_enqueue_with_app_context(archive_call_data))
+    schedule.every(24).hours.do(rq_enqueue_with_app_context(apply_retention))
 
     while True:
         schedule.run_pending()
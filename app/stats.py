@@ -0,0 +1,253 @@
+"""Call statistics per service number, agent and hour
+
+The statistics of each closed call session are stored in the same
+transaction as its call data, and triggers add them to hourly rollups (see
+model/call_stats.py), so any range is answered without reading call data:
+
+  /stats/calls.json?from=...&to=...[&by=service,agent,hour]
+
+  flask backfill-stats [--rebuild]
+
+computes the statistics of call sessions stored before there were any,
+including the archived ones.
+"""
+
+from itertools import groupby
+import time
+
+import click
+from flask import Blueprint, abort, current_app, jsonify, request
+from flask.cli import with_appcontext
+
+from .archive import archived_months, attached_archive
+from .auth import login_require_role
+from .db import get_db, transaction
+from .model.call_stats import (
+    STATS_COUNTERS,
+    CallSessionStats,
+    insert_call_session_stats,
+)
+from .utils import QUERY_BATCH_SIZE, batches, epoch_arg
+
+
+stats = Blueprint('stats', __name__)
+
+
+_sql_stats_channels = """\
+select
+    call_sessions.call_session_id,
+    call_sessions.start_timestamp,
+    call_sessions.end_timestamp,
+    call_channels.call_direction,
+    call_channels.end_point_class,
+    call_channels.active,
+    call_channels.answered,
+    call_channels.call_timestamp,
+    call_channels.answer_timestamp,
+    call_channels.hangup_timestamp,
+    call_channels.login_id,
+    call_channels.service_number_id
+from {schema}.call_sessions call_sessions
+join {schema}.call_channels call_channels using (call_session_id)
+where call_sessions.call_session_id in ({placeholders})
+and call_sessions.end_timestamp is not null
+and call_sessions.call_session_id not in
+    (select call_session_id from main.call_session_stats)
+order by call_sessions.call_session_id,
+    call_channels.call_timestamp, call_channels.call_channel_id
+"""
+
+
+def _to_agent(call_channel):
+    return (call_channel['end_point_class'] == 'i'
+            and call_channel['call_direction'] == 'o')
+
+
+def _duration(start, stop):
+    if start is None or stop is None:
+        return 0.0
+    return max(stop - start, 0.0)
+
+
+def session_stats(call_session_id, call_channels) -> CallSessionStats|None:
+    """computes the statistics of a closed call session from its channels
+
+    Incoming calls count for the service number called, and for the agent
+    who answered. Outgoing calls count for the agent calling. Returns None
+    while a call channel is still active.
+    """
+    if any(call_channel['active'] for call_channel in call_channels):
+        return None
+    first = call_channels[0]
+    service_number_id, login_id = 0, 0
+    incoming, answered, abandoned, outgoing = 0, 0, 0, 0
+    wait_time, talk_time, outgoing_talk_time = 0.0, 0.0, 0.0
+    end_timestamp = first['end_timestamp']
+
+    if first['call_direction'] == 'i':
+        incoming = 1
+        service_number_id = first['service_number_id'] or 0
+        agent_channel = next((call_channel for call_channel in call_channels[1:]
+                              if _to_agent(call_channel) and call_channel['answered']),
+                             None)
+        if agent_channel is not None:
+            answered = 1
+            login_id = agent_channel['login_id'] or 0
+            wait_time = _duration(first['call_timestamp'],
+                                  agent_channel['answer_timestamp'])
+            talk_time = _duration(agent_channel['answer_timestamp'],
+                                  agent_channel['hangup_timestamp'] or end_timestamp)
+        else:
+            abandoned = 1
+            wait_time = _duration(first['call_timestamp'],
+                                  first['hangup_timestamp'] or end_timestamp)
+    elif _to_agent(first):
+        outgoing = 1
+        login_id = first['login_id'] or 0
+        if len(call_channels) >= 2 and call_channels[1]['answered']:
+            outgoing_talk_time = _duration(
+                call_channels[1]['answer_timestamp'],
+                call_channels[1]['hangup_timestamp'] or end_timestamp)
+
+    return CallSessionStats(
+        call_session_id = call_session_id,
+        hour = int(first['start_timestamp'] // 3600 * 3600),
+        service_number_id = service_number_id,
+        login_id = login_id,
+        incoming = incoming,
+        answered = answered,
+        abandoned = abandoned,
+        outgoing = outgoing,
+        wait_time = wait_time,
+        talk_time = talk_time,
+        outgoing_talk_time = outgoing_talk_time,
+    )
+
+
+def store_call_session_stats(db, call_session_ids, schema='main') -> int:
+    """computes and stores the missing statistics among `call_session_ids`
+
+    Called in the transaction that upserted the call sessions, after the
+    triggers on call_channels removed the statistics that changed. Sessions
+    still in progress are skipped, until they close. Returns the number of
+    call sessions stored.
+    """
+    stored = 0
+    for batch in batches(call_session_ids):
+        rows = db.execute(
+            _sql_stats_channels.format(schema=schema,
+                                       placeholders=', '.join('?' * len(batch))),
+            batch).fetchall()
+        for call_session_id, call_channels in groupby(rows, lambda row: row[0]):
+            call_session_stats = session_stats(call_session_id, list(call_channels))
+            if call_session_stats is not None:
+                stored += db.execute(insert_call_session_stats,
+                                     call_session_stats).rowcount
+    return stored
+
+
+def _backfill_schema(db, schema) -> int:
+    stored = 0
+    last_id = b''
+    while True:
+        batch = [row[0] for row in db.execute(
+            f'select call_session_id from {schema}.call_sessions '
+            'where call_session_id > ? order by call_session_id limit ?',
+            (last_id, QUERY_BATCH_SIZE)).fetchall()]
+        if not batch:
+            return stored
+        with transaction(db):
+            stored += store_call_session_stats(db, batch, schema)
+        last_id = batch[-1]
+
+
+def _backfill_logged(db, schema) -> int:
+    count = _backfill_schema(db, schema)
+    current_app.logger.info(f'Stored statistics of {count} call sessions '
+                            f'from {schema}')
+    return count
+
+
+def backfill_stats(rebuild=False) -> int:
+    """stores the missing statistics of all call sessions, returns the count
+
+    With `rebuild`, all statistics are computed again.
+    """
+    db = get_db()
+    if rebuild:
+        with transaction(db):
+            db.execute('delete from call_stats_hourly')
+            db.execute('delete from call_session_stats')
+    stored = 0
+    # one archive attached at a time, SQLite allows only a few at once
+    for year, month in archived_months():
+        with attached_archive(db, year, month) as schema:
+            stored += _backfill_logged(db, schema)
+    return stored + _backfill_logged(db, 'main')
+
+
+@click.command('backfill-stats')
+@click.option('--rebuild', is_flag=True,
+              help='compute the statistics of all call sessions again')
+@with_appcontext
+def cmd_backfill_stats(rebuild):
+    start = time.perf_counter()
+    stored = backfill_stats(rebuild)
+    print(f'Stored statistics of {stored} call sessions '
+          f'in {time.perf_counter() - start:.1f}s')
+
+
+# (column, name) of the key, and of its label, for each grouping
+_groupings = {
+    'service': (('call_stats_hourly.service_number_id', 'service_number_id'),
+                ('service_numbers.service_number_description', 'service_number')),
+    'agent': (('call_stats_hourly.login_id', 'agent_id'),
+              ("nullif(trim(coalesce(agents.agent_first_name, '') || ' ' "
+               "|| coalesce(agents.agent_last_name, '')), '')", 'agent')),
+    'hour': (('call_stats_hourly.hour', 'hour'), ),
+}
+
+
+def _rate(numerator, denominator):
+    return numerator / denominator if denominator else None
+
+
+@stats.route('/stats/calls.json')
+@login_require_role('admin')
+def stats_json():
+    """returns the statistics for [from, to), grouped by `by`
+
+    The range is rounded down to whole hours.
+    """
+    from_epoch, to_epoch = epoch_arg('from'), epoch_arg('to')
+    by = [name for name in request.args.get('by', 'service').split(',') if name]
+    if not by or any(name not in _groupings for name in by):
+        abort(400, f'by must be some of {", ".join(_groupings)}')
+    keys = [_groupings[name][0][0] for name in by]
+    columns = [column for name in by for column in _groupings[name]]
+    sums = ', '.join(f'sum(call_stats_hourly.{name})' for name in STATS_COUNTERS)
+    rows = get_db().execute(
+        f'select {", ".join(sql for sql, _ in columns)}, {sums} '
+        'from call_stats_hourly '
+        'left outer join service_numbers '
+        '    on service_numbers.service_number_id = call_stats_hourly.service_number_id '
+        'left outer join agents '
+        '    on agents.agent_id = call_stats_hourly.login_id '
+        'where call_stats_hourly.hour >= ? and call_stats_hourly.hour < ? '
+        f'group by {", ".join(keys)} '
+        f'order by {", ".join(keys)}',
+        (from_epoch // 3600 * 3600, to_epoch)).fetchall()
+
+    names = [name for _, name in columns] + list(STATS_COUNTERS)
+    result = []
+    for row in rows:
+        item = dict(zip(names, row))
+        item['answer_rate'] = _rate(item['answered'], item['incoming'])
+        item['average_wait'] = _rate(item['wait_time'], item['incoming'])
+        item['average_talk_time'] = _rate(item['talk_time'], item['answered'])
+        result.append(item)
+    return jsonify(result)
+
+
+def init_app(app):
+    app.cli.add_command(cmd_backfill_stats)
@@ -1,11 +1,15 @@
-from base64 import b85decode, b85encode
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 import json
 import math
 import re
 from uuid import UUID
 
 from dateutil.parser import parse as parse_iso_date
+from flask import abort, request
+
+
+QUERY_BATCH_SIZE = 500 # ids per query, well below SQLite's parameter limit
 
 
 def get_conversion(converter, value, fallback=None):
@@ -15,16 +19,114 @@ def get_conversion(converter, value, fallback=None):
         return fallback
 
 
-def uuid_compact(uuid_string: str) -> str:
-    return b85encode(UUID(uuid_string).bytes).decode(encoding='ascii')
+def batches(items, size=QUERY_BATCH_SIZE):
+    """yields `items` in slices of at most `size`
+
+    >>> list(batches([1, 2, 3, 4, 5], 2))
+    [[1, 2], [3, 4], [5]]
+    """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def uuid_compact(uuid_string: str) -> bytes:
+    """converts a uuid to the 16 byte form used as key in the database
 
+    >>> uuid_compact('12345678-9abc-def0-1234-56789abcdef0').hex()
+    '123456789abcdef0123456789abcdef0'
+    """
+    return UUID(uuid_string).bytes
 
-def uuid_expand(compact_uuid: str) -> str:
-    return str(UUID(bytes=b85decode(compact_uuid)))
+
+def uuid_expand(compact_uuid: bytes) -> str:
+    """converts a uuid from the database to its usual string form
+
+    >>> uuid_expand(bytes.fromhex('123456789abcdef0123456789abcdef0'))
+    '12345678-9abc-def0-1234-56789abcdef0'
+    """
+    return str(UUID(bytes=compact_uuid))
+
+
+_iso_datetime_regexp = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:[.,](\d{1,6})\d*)?'
+    r'(Z|[+-]\d\d(?::?\d\d)?)?$')
+
+
+@lru_cache(maxsize=32)
+def _utc_offset(designator: str) -> timezone:
+    if designator == 'Z':
+        return timezone.utc
+    hours, minutes = int(designator[1:3]), int(designator[-2:] if len(designator) > 3 else 0)
+    offset = timedelta(hours=hours, minutes=minutes)
+    return timezone(-offset if designator[0] == '-' else offset)
 
 
 def iso_datetime_to_epoch(iso_datetime: str) -> float:
-    return parse_iso_date(iso_datetime).timestamp()
+    """converts an ISO 8601 timestamp to seconds since epoch
+
+    The formats emitted by Zisson are decoded directly, anything else is
+    left to dateutil. Timestamps without offset are in local time.
+
+    >>> iso_datetime_to_epoch('2022-03-01T08:00:00Z')
+    1646121600.0
+    >>> iso_datetime_to_epoch('2022-03-01T09:00:00.25+01:00')
+    1646121600.25
+    >>> iso_datetime_to_epoch('March 1st 2022, 08:00 UTC')
+    1646121600.0
+    """
+    if (match := _iso_datetime_regexp.match(iso_datetime)) is None:
+        return parse_iso_date(iso_datetime).timestamp()
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    return datetime(int(year), int(month), int(day),
+                    int(hour), int(minute), int(second),
+                    int(fraction.ljust(6, '0')) if fraction else 0,
+                    None if offset is None else _utc_offset(offset)
+                    ).timestamp()
+
+
+def text_to_epoch(text: str) -> float:
+    """converts seconds since epoch, or an ISO 8601 timestamp, to seconds
+
+    >>> text_to_epoch('1646121600')
+    1646121600.0
+    >>> text_to_epoch('2022-03-01T08:00:00Z')
+    1646121600.0
+    """
+    try:
+        return float(text)
+    except ValueError:
+        return iso_datetime_to_epoch(text)
+
+
+def epoch_arg(name) -> float:
+    """returns request argument `name`, in seconds since epoch
+
+    Aborts with 400 when it is missing or not a timestamp.
+    """
+    if (value := request.args.get(name)) is None:
+        abort(400, f'missing argument {name}')
+    try:
+        return text_to_epoch(value)
+    except (ValueError, OverflowError):
+        abort(400, f'invalid {name}: {value}')
+
+
+def iso_datetimes_to_epochs(iso_datetimes) -> list[float|None]:
+    """converts many ISO 8601 timestamps (or None) at once
+
+    Repeated timestamps are only decoded once.
+
+    >>> iso_datetimes_to_epochs(['2022-03-01T08:00:00Z', None,
+    ...                          '2022-03-01T08:00:00Z'])
+    [1646121600.0, None, 1646121600.0]
+    """
+    epochs = {None: None}
+    result = []
+    for iso_datetime in iso_datetimes:
+        if iso_datetime not in epochs:
+            epochs[iso_datetime] = iso_datetime_to_epoch(iso_datetime)
+        result.append(epochs[iso_datetime])
+    return result
 
 
 def str_to_bool(text: str) -> bool:
@@ -1,32 +1,153 @@
-from collections import namedtuple
-from datetime import datetime, timedelta
+from dataclasses import dataclass
+from datetime import timedelta
+import os
+import random
+from threading import Lock
+import time
 
 from flask import current_app
-import lxml.etree
 import requests
+from requests.adapters import HTTPAdapter
 
 from .db import get_db
-from .parse_xml import subtext, subint
+from .model.customer_data import select_agent_phone
 
 
 DIURNAL_CYCLE = timedelta(hours=24)
 
-def zisson_api_get(path, params=None):
+RETRY_BACKOFF = 0.5 # seconds, doubled for each retry
+
+
+@dataclass
+class ApiLatency:
+    """request count and latency of one endpoint
+
+    >>> latency = ApiLatency()
+    >>> latency.add(0.25, failed=False)
+    >>> latency.add(0.75, failed=True)
+    >>> print(latency)
+    2 requests, 1 failed, mean 0.500s, max 0.750s
+    """
+    requests: int = 0
+    failures: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+    def add(self, seconds: float, failed: bool):
+        self.requests += 1
+        self.failures += int(failed)
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def __str__(self):
+        return (f'{self.requests} requests, {self.failures} failed, '
+                f'mean {self.total_seconds / max(self.requests, 1):.3f}s, '
+                f'max {self.max_seconds:.3f}s')
+
+
+api_latency = {} # per endpoint (path) in this process
+_http_session = None
+_http_session_pid = None
+_http_session_lock = Lock()
+
+
+def get_http_session() -> requests.Session:
+    """returns the process wide pooled session, with keep-alive
+
+    A forked process (like an rq job) gets its own session.
+    """
+    global _http_session, _http_session_pid
+    with _http_session_lock:
+        if _http_session is None or _http_session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=8)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            _http_session, _http_session_pid = session, os.getpid()
+        return _http_session
+
+
+def log_api_latency():
+    """logs, and resets, the latency of each endpoint called in this process
+
+    Called after each rq job, see rq_worker.FlaskWorker.
+    """
+    for path, latency in sorted(api_latency.items()):
+        current_app.logger.info(f'Zisson api {path}: {latency}')
+    api_latency.clear()
+
+
+def _retryable(err: requests.RequestException) -> bool:
+    """tells whether a failed request is worth retrying
+
+    >>> def http_error(status_code):
+    ...     response = requests.Response()
+    ...     response.status_code = status_code
+    ...     return requests.HTTPError(response=response)
+    >>> _retryable(http_error(503)), _retryable(http_error(404))
+    (True, False)
+    >>> _retryable(requests.ConnectionError()), _retryable(requests.Timeout())
+    (True, True)
+    >>> _retryable(requests.TooManyRedirects())
+    False
+    """
+    if isinstance(err, requests.HTTPError):
+        return err.response is not None and err.response.status_code >= 500
+    return isinstance(err, (requests.ConnectionError, requests.Timeout))
+
+
+def _retry_delay(attempt: int) -> float:
+    """returns the jittered delay before retry number `attempt` + 1
+
+    Full jitter: uniform between 0 and RETRY_BACKOFF * 2**attempt.
+
+    >>> all(0 <= _retry_delay(attempt) <= RETRY_BACKOFF * 2 ** attempt
+    ...     for attempt in range(5) for _ in range(100))
+    True
+    >>> max(_retry_delay(3) for _ in range(1000)) > RETRY_BACKOFF * 2 ** 2
+    True
+    """
+    return random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+
+
+def zisson_api_get(path, params=None, retries=None):
+    """GET from the Zisson simple api, returns the content or None
+
+    Server errors and connection errors are retried up to `retries` times
+    (default ZISSON_API_RETRIES) with jittered exponential backoff.
+    """
     if 'ZISSON_API_PASSWORD' not in current_app.config:
         return
 
-    hostname = current_app.config['ZISSON_API_HOST']
-    username = current_app.config['ZISSON_API_USERNAME']
-    password = current_app.config['ZISSON_API_PASSWORD']
-    try:
-        response = requests.get(f'https://{hostname}/api/simple/{path}',
-                                params=params,
-                                auth=(username, password))
-        response.raise_for_status()
-        return response.content
-    except requests.RequestException as err:
-        current_app.logger.warn(str(err))
-        return None
+    config = current_app.config
+    hostname = config['ZISSON_API_HOST']
+    username = config['ZISSON_API_USERNAME']
+    password = config['ZISSON_API_PASSWORD']
+    timeout = (float(config['ZISSON_API_CONNECT_TIMEOUT']),
+               float(config['ZISSON_API_READ_TIMEOUT']))
+    if retries is None:
+        retries = int(config['ZISSON_API_RETRIES'])
+    latency = api_latency.setdefault(path, ApiLatency())
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            response = get_http_session().get(
+                f'{config["ZISSON_API_SCHEME"]}://{hostname}/api/simple/{path}',
+                params=params,
+                auth=(username, password),
+                timeout=timeout)
+            response.raise_for_status()
+            latency.add(time.perf_counter() - start, failed=False)
+            return response.content
+        except requests.RequestException as err:
+            latency.add(time.perf_counter() - start, failed=True)
+            if attempt >= retries or not _retryable(err):
+                current_app.logger.warn(str(err))
+                return None
+            delay = _retry_delay(attempt)
+            current_app.logger.info(f'{path}: {err}, retrying in {delay:.1f}s')
+            time.sleep(delay)
 
 
 def dial(from_number, to_number):
@@ -41,60 +162,20 @@ def dial(from_number, to_number):
                                       params = {
                                           'from': from_number,
                                           'to': to_number
-                                      })
+                                      },
+                                      retries = 0) # never dial twice
     current_app.logger.info(f"response content = {response_content}")
     if response_content != b'1':
         raise RuntimeError(f"Failed to dial from {from_number} to {to_number}")
 
 
-LogonEvent = namedtuple('LogonEvent', ['agent_id', 'location_id', 'logon', 'timestamp'])
-
-
-def get_agent_location_map():
-    """returns a dict mapping agent_id to location_id"""
-    now = (datetime.utcnow() + timedelta(hours=24)).isoformat(timespec='seconds')+'Z'
-    yesterday = (datetime.utcnow() - timedelta(hours=24)).isoformat(timespec='seconds')+'Z'
-    xmldata = zisson_api_get('AgentQueueStatusEvents',
-                              params = {
-                                  'start_date': yesterday,
-                                  'end_date': now,
-                                  'logon_events': '1',
-                              })
-    if xmldata == None:
-        return {}
-    data = lxml.etree.fromstring(xmldata)
-
-    logon_events = []
-    for logon_event in data.xpath('/AgentQueueStatusEvents/LogonEvents/LogonEvent'):
-        logon_events.append(LogonEvent(
-            agent_id = subint(logon_event, 'LoginId'),
-            location_id = subint(logon_event, 'Userid'),
-            logon = (subtext(logon_event, 'EventName') == 'QueueLogon'),
-            timestamp = subtext(logon_event, 'ActionTimeStampUtc'),
-        ))
-    logon_events.sort(key = lambda event: event.timestamp)
-
-    agent_location = {}
-    for event in logon_events:
-        if event.logon:
-            agent_location[event.agent_id] = event.location_id
-        elif event.agent_id in agent_location:
-            del agent_location[event.agent_id]
-    return agent_location
-
-
 def email_to_current_phone(email: str, fallback_phone = None) -> int|None:
-    try:
-        user_id = get_db().execute(
-            "select agent_id from agents where agent_email = ?",
-            (email,)).fetchone()[0]
-        agent_location = get_agent_location_map()
-        location_id = agent_location[user_id]
-        phone = get_db().execute(
-            "select location_number from internal_phones where location_id = ?",
-            (location_id, )).fetchone()[0]
-        return phone
-    except (TypeError, KeyError):
-        return fallback_phone
-
+    """returns the phone the agent with `email` is currently logged on to
 
+    Looks in agent_locations, which is kept up to date from the logon
+    events by fetch.fetch_agent_locations.
+    """
+    row = get_db().execute(select_agent_phone, (email, )).fetchone()
+    if row is None or row[0] is None:
+        return fallback_phone
+    return row[0]
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""Micro benchmarks for the hot paths of phonelog
+
+Uses synthetic data, no Zisson credentials or running services needed.
+Run from the repository root:
+
+  python debug/benchmark.py parse [--sessions N]
+  python debug/benchmark.py scaling [--sizes N,N,...]
+  python debug/benchmark.py views [--sessions N] [--requests N]
+  python debug/benchmark.py queries [--sessions N]
+
+The doctests (python doctestmod.py debug/benchmark.py) check that the
+queries per history page render do not grow with the call sessions shown.
+"""
+
+import argparse
+from datetime import datetime, timedelta, timezone
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from uuid import UUID
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import create_app
+from app.db import get_db, transaction
+from app.format_calldata import store_call_session_summaries
+from app.model.call_data import upsert_call_data
+from app.parse_xml import iter_call_data, parse_call_data
+
+
+def _timestamp(when):
+    return when.isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+def synthetic_xml_export(sessions, seed=0):
+    """returns an XmlExport page with `sessions` call sessions"""
+    rnd = random.Random(seed)
+    start = datetime(2022, 1, 1, 8, tzinfo=timezone.utc)
+    parts = ['<?xml version="1.0" encoding="utf-8"?>\n<XmlExport>']
+    for session_no in range(sessions):
+        t0 = start + timedelta(seconds=30 * session_no)
+        channel_ids = [str(UUID(int=rnd.getrandbits(128)))
+                       for _ in range(rnd.randint(1, 6))]
+        parts.append(
+            f'<CallSession>'
+            f'<CallSessionId>{UUID(int=rnd.getrandbits(128))}</CallSessionId>'
+            f'<StartTimestamp>{_timestamp(t0)}</StartTimestamp>'
+            f'<EndTimestamp>{_timestamp(t0 + timedelta(minutes=3))}</EndTimestamp>'
+            f'<CallChannels>')
+        for channel_no, channel_id in enumerate(channel_ids):
+            t = t0 + timedelta(seconds=channel_no)
+            parts.append(
+                f'<CallChannel>'
+                f'<CallChannelId>{channel_id}</CallChannelId>'
+                f'<CallDirection>{"Outgoing" if channel_no else "Incoming"}</CallDirection>'
+                f'<ANumber>+479{rnd.randint(0, 9999999):07d}</ANumber>'
+                f'<BNumber>+4722{channel_no:06d}</BNumber>'
+                f'<EndPointClass>{"Internal" if channel_no else "External"}</EndPointClass>'
+                f'<CallState>Terminated</CallState>'
+                f'<Active>False</Active>'
+                f'<Answered>True</Answered>'
+                f'<HangupBy>Caller</HangupBy>'
+                f'<HangupReason>Normal</HangupReason>'
+                f'<CallTimestamp>{_timestamp(t)}</CallTimestamp>'
+                f'<RingingTimestamp>{_timestamp(t + timedelta(seconds=1))}</RingingTimestamp>'
+                f'<AnswerTimestamp>{_timestamp(t + timedelta(seconds=5))}</AnswerTimestamp>'
+                f'<HangupTimestamp>{_timestamp(t + timedelta(seconds=90))}</HangupTimestamp>'
+                f'<LoginId>{rnd.randint(1, 20)}</LoginId>'
+                f'<LocationId>{rnd.randint(1, 20)}</LocationId>'
+                f'<DeviceId>{rnd.randint(1, 20)}</DeviceId>'
+                f'</CallChannel>')
+        parts.append('</CallChannels><ServiceNumbers>')
+        for channel_no, channel_id in enumerate(channel_ids):
+            parts.append(
+                f'<ServiceNumber>'
+                f'<ServiceNumberId>{channel_no + 1}</ServiceNumberId>'
+                f'<Number>+4722{channel_no:06d}</Number>'
+                f'<CallChannelId>{channel_id}</CallChannelId>'
+                f'</ServiceNumber>')
+        parts.append('</ServiceNumbers><RecordingSessions>')
+        for channel_id in channel_ids[1:2]:
+            parts.append(
+                f'<RecordingSession>'
+                f'<RecordingId>{UUID(int=rnd.getrandbits(128))}</RecordingId>'
+                f'<CallChannelId>{channel_id}</CallChannelId>'
+                f'<StartTimestamp>{_timestamp(t0)}</StartTimestamp>'
+                f'<StopTimestamp>{_timestamp(t0 + timedelta(minutes=2))}</StopTimestamp>'
+                f'<RecordingStatus>Completed</RecordingStatus>'
+                f'</RecordingSession>')
+        parts.append('</RecordingSessions></CallSession>')
+    parts.append('</XmlExport>')
+    return '\n'.join(parts).encode(encoding='utf-8')
+
+
+def _max_rss_kib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _in_child(func, *args):
+    """runs `func(*args)` in a forked child process
+
+    Returns (seconds, peak RSS growth in KiB), so each measurement starts
+    with the same heap.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        rss_before = _max_rss_kib()
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        os.write(write_fd, f"{elapsed} {_max_rss_kib() - rss_before}".encode())
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as fp:
+        elapsed, rss = fp.read().split()
+    os.waitpid(pid, 0)
+    return float(elapsed), int(rss)
+
+
+def _consume_tree(xmldata):
+    parse_call_data(xmldata)
+
+
+def _consume_stream(xmldata):
+    for _ in iter_call_data(xmldata):
+        pass
+
+
+def bench_parse(args):
+    xmldata = synthetic_xml_export(args.sessions)
+    print(f"XmlExport page: {args.sessions} call sessions, {len(xmldata)} bytes")
+    for name, func in (('parse_call_data', _consume_tree),
+                       ('iter_call_data', _consume_stream)):
+        elapsed, rss = _in_child(func, xmldata)
+        print(f"{name:>16}: {elapsed:8.3f} s "
+              f"{args.sessions / elapsed:10.0f} sessions/s "
+              f"{rss / 1024:8.1f} MiB peak RSS growth")
+
+
+def bench_scaling(args):
+    print(f"{'sessions':>10} {'seconds':>10} {'us/session':>12}")
+    for sessions in args.sizes:
+        xmldata = synthetic_xml_export(sessions)
+        start = time.perf_counter()
+        parse_call_data(xmldata)
+        elapsed = time.perf_counter() - start
+        print(f"{sessions:>10} {elapsed:>10.3f} {elapsed / sessions * 1e6:>12.1f}")
+
+
+BENCHMARK_TOKEN = 'benchmark'
+
+
+def synthetic_app(database, sessions, **config):
+    """returns an app with `sessions` synthetic call sessions in `database`"""
+    app = create_app(test_config=dict(DATABASE=database,
+                                      SECRET_KEY='benchmark',
+                                      **config))
+    with app.app_context():
+        db = get_db()
+        if not db.execute('select 1 from users').fetchone():
+            with transaction(db):
+                call_session_ids = []
+                for call_data in iter_call_data(synthetic_xml_export(sessions)):
+                    upsert_call_data(db, *call_data)
+                    call_session_ids.append(call_data[0].call_session_id)
+                store_call_session_summaries(db, call_session_ids)
+                db.execute("insert into users (username, password_hash, roles, token) "
+                           "values ('benchmark', '', 'agent', ?)",
+                           (BENCHMARK_TOKEN, ))
+    return app
+
+
+def _requests_per_second(app, path, requests):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = BENCHMARK_TOKEN
+        session['_fresh'] = True
+    if (status := client.get(path).status_code) != 200:
+        raise RuntimeError(f'{path}: status {status}')
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.get(path)
+    return requests / (time.perf_counter() - start)
+
+
+def bench_views(args):
+    from_epoch = datetime(2022, 1, 1, tzinfo=timezone.utc).timestamp()
+    paths = ('/live', f'/history?from={from_epoch:.0f}')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database = os.path.join(tmpdir, 'benchmark.sqlite')
+        synthetic_app(database, args.sessions)
+        print(f"{args.sessions} call sessions, {args.requests} requests per view")
+        print(f"{'DATABASE_POOL_SIZE':>20} " + ' '.join(f"{path.split('?')[0]:>12}" for path in paths))
+        for pool_size in (0, 8):
+            app = synthetic_app(database, args.sessions,
+                                DATABASE_POOL_SIZE=pool_size)
+            print(f"{pool_size:>20} " + ' '.join(
+                f"{_requests_per_second(app, path, args.requests):>8.1f} r/s"
+                for path in paths))
+
+
+def history_queries(sessions):
+    """counts the SQL statements of a cold and a warm history page render
+
+    Returns {render: (statements, call channel queries)}. The cold render
+    also builds the number directory, once per process. The warm count
+    does not grow with the number of call sessions shown:
+
+    >>> small, large = history_queries(10), history_queries(200)
+    >>> small['warm'] == large['warm'], large['warm'][1]
+    (True, 0)
+    """
+    from_epoch = datetime(2022, 1, 1, tzinfo=timezone.utc).timestamp()
+    path = f'/history?from={from_epoch:.0f}'
+    counts = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # a single pooled connection, so the trace sees every request
+        app = synthetic_app(os.path.join(tmpdir, 'benchmark.sqlite'),
+                            sessions, DATABASE_POOL_SIZE=1)
+        statements = []
+        with app.app_context():
+            get_db().set_trace_callback(statements.append)
+        for render in ('cold', 'warm'):
+            statements.clear()
+            _requests_per_second(app, path, 0)
+            joins = sum('from main.call_channels' in sql for sql in statements)
+            counts[render] = (len(statements), joins)
+    return counts
+
+
+def bench_queries(args):
+    """counts the SQL statements of one render of the history page"""
+    for render, (statements, joins) in history_queries(args.sessions).items():
+        print(f"{render:>5} render of {args.sessions} call sessions: "
+              f"{statements} statements, {joins} call channel queries")
+
+
+def _int_list(text):
+    return [int(value) for value in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    parse = commands.add_parser('parse',
+                                help='parse_call_data vs iter_call_data')
+    parse.add_argument('--sessions', type=int, default=5000)
+    parse.set_defaults(func=bench_parse)
+    scaling = commands.add_parser('scaling',
+                                  help='parse time as a function of page size')
+    scaling.add_argument('--sizes', type=_int_list,
+                         default=[250, 500, 1000, 2000, 4000])
+    scaling.set_defaults(func=bench_scaling)
+    views = commands.add_parser('views',
+                                help='requests per second of history and live views')
+    views.add_argument('--sessions', type=int, default=100)
+    views.add_argument('--requests', type=int, default=20)
+    views.set_defaults(func=bench_views)
+    queries = commands.add_parser('queries',
+                                  help='SQL statements per history page render')
+    queries.add_argument('--sessions', type=int, default=100)
+    queries.set_defaults(func=bench_queries)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()